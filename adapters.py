@@ -1,12 +1,22 @@
-from time import sleep
+import array
 import socket
+import struct
+import threading
 from collections import OrderedDict
+from math import ceil
 from random import uniform, choice
+from select import select
 
 import win_inet_pton  # noqa -- ignore the unused import error
-from pyModbusTCP.client import ModbusClient
 
+import modbus
 from devices import DIn, DOut, AIn, AOut
+from ioimage import BitImage, RegisterImage
+from scaling import BatchScaler
+from timing import monotonic
+
+
+connection_pool = modbus.ConnectionPool()  # Default pool for Modbus adapters
 
 
 class ConnectionError(Exception):
@@ -14,10 +24,94 @@ class ConnectionError(Exception):
     pass
 
 
+def plan_reads(devices, max_count, max_gap):
+    """Split the address map of a list of devices (sorted by address) into as few read requests as possible.
+
+    Neighbouring devices share a request if there are at most max_gap unused addresses between them and the request
+    would not span more than max_count addresses. Returns a list of (start address, count, devices) tuples.
+    """
+    blocks = []
+    members = []
+    for d in devices:
+        last = d.address + d.length - 1
+        if members and d.address - end - 1 <= max_gap and max(end, last) - start + 1 <= max_count:
+            end = max(end, last)
+            members.append(d)
+        else:
+            if members:
+                blocks.append((start, end - start + 1, members))
+            start, end, members = d.address, last, [d]
+
+    if members:
+        blocks.append((start, end - start + 1, members))
+    return blocks
+
+
+def plan_read_groups(devices, max_count, max_gap):
+    """Plan the reads of a list of devices (sorted by address) separately for each poll interval, so that slowly
+    polled devices do not lengthen the reads of the others. Returns the blocks of all groups, as for plan_reads."""
+    groups = OrderedDict()  # Devices for each poll interval, in order of address
+    for d in devices:
+        groups.setdefault(d.poll_interval, []).append(d)
+
+    blocks = []
+    for group in groups.values():
+        blocks += plan_reads(group, max_count, max_gap)
+    return blocks
+
+
+def plan_writes(devices, max_count, refresh=False):
+    """Group the changed devices in a list of output devices (sorted by address) into write requests.
+
+    A request covers devices at contiguous addresses only, since writing to the addresses in between could overwrite
+    outputs that are not configured. Unchanged devices between changed ones are rewritten with their current values
+    rather than splitting the request. If refresh is True, all devices count as changed. Returns a list of device
+    lists, one per request.
+    """
+    blocks = []
+    block = []  # Devices from the first changed one onwards
+    n = 0  # Number of devices in the block up to and including the last changed one
+    for d in devices:
+        if block and (d.address != block[-1].address + block[-1].length or
+                      d.address + d.length - block[0].address > max_count):
+            blocks.append(block[:n])
+            block = []
+
+        if d.dirty or refresh:
+            block.append(d)
+            n = len(block)
+        elif block:
+            block.append(d)
+
+    if block:
+        blocks.append(block[:n])
+    return blocks
+
+
 class Adapter(object):
-    """A generic remote IO rack."""
-    def __init__(self, ip_address=None):
+    """A generic remote IO rack.
+
+    Each adapter keeps track of its own connection state. A failed connection attempt is retried after a delay that
+    doubles with every failure (up to MAX_RECONNECT_DELAY) until the adapter has completed a scan, and the adapter's
+    devices are marked as stale until then.
+    """
+    DISCONNECTED = 'disconnected'  # Connection states
+    CONNECTING = 'connecting'
+    CONNECTED = 'connected'
+
+    RECONNECT_DELAY = 0.5  # Delay before the first reconnection attempt (s)
+    MAX_RECONNECT_DELAY = 30.0
+
+    def __init__(self, ip_address=None, scan_interval=None):
         self.ip_address = ip_address
+        self.scan_interval = scan_interval  # Time between scans (s); None = use the controller's cycle time
+        self.timer = None  # CycleTimer pacing the adapter's scan thread
+        self.lock = threading.Lock()  # Held while device values are updated, so that the controller can take consistent snapshots
+        self.state = self.DISCONNECTED
+        self.stale = False  # Whether the device values are out of date because the connection is down
+        self.reconnects = 0  # Number of times the connection has been re-established after being lost
+        self.retry_delay = self.RECONNECT_DELAY  # Delay before the next connection attempt (s)
+        self._was_connected = False
 
         self.devices = {}  # Dictionary of all devices (key: tag name, value: Device object)
         self.d_ins = {}  # Dictionary of digital input devices (key: address, value: Device object)
@@ -64,21 +158,82 @@ class Adapter(object):
             adjust_range(self.a_out_range, d)
 
     def start(self):
-        """Start connection/data collection. Override in child class."""
+        """Start connection/data collection. Override in child class.
+
+        Makes a single attempt and raises ConnectionError if it fails; see connect() for retrying.
+        """
         pass
 
     def stop(self):
         """Stop connection/data collection. Override in child class."""
         pass
 
+    def connect(self):
+        """Attempt to connect once. Returns the time to wait before the next attempt (s), or 0 if connected."""
+        self.state = self.CONNECTING
+        try:
+            self.start()
+        except ConnectionError as e:
+            self.state = self.DISCONNECTED
+            delay = self.backoff()
+            print '{}; retrying in {:.1f} s'.format(e, delay)
+            return delay
+
+        self.state = self.CONNECTED
+        if self._was_connected:
+            self.reconnects += 1
+        self._was_connected = True
+        return 0
+
+    def backoff(self):
+        """Time to wait before the next connection attempt (s). Doubles every time, until reset by online()."""
+        delay = self.retry_delay * uniform(0.8, 1.2)  # Jitter, so that adapters sharing a fault don't retry in step
+        self.retry_delay = min(2 * self.retry_delay, self.MAX_RECONNECT_DELAY)
+        return delay
+
+    def online(self):
+        """Record a successful scan: the devices are up to date and the connection is known to work"""
+        if self.stale:
+            self.set_stale(False)
+        self.retry_delay = self.RECONNECT_DELAY
+
+    def disconnect(self):
+        """Close the connection after it has failed, and mark the devices as stale until it has been re-established"""
+        self.stop()
+        self.state = self.DISCONNECTED
+        self.set_stale(True)
+
+    @property
+    def connected(self):
+        return self.state == self.CONNECTED
+
+    def set_stale(self, stale):
+        with self.lock:
+            for device in self.devices.values():
+                device.stale = stale
+        self.stale = stale
+
     def read_all(self):
-        """Read all devices/addresses associated with the rack. Override in child class."""
+        """Read all devices/addresses associated with the rack. Override in child class.
+
+        Do any network I/O before acquiring self.lock and only hold the lock while updating device values.
+        """
         pass
 
     def write_all(self):
         """Write to all devices/addresses associated with the rack. Override in child class."""
         pass
 
+    @property
+    def sample_rate(self):
+        """Rate at which new readings arrive (Hz), for sizing device logs. Override in child class if not scanned."""
+        return 1.0 / self.scan_interval
+
+    def scan(self):
+        """Read all inputs and write all outputs. Override in child class if the two can be done together."""
+        self.read_all()
+        self.write_all()
+
     def __repr__(self):
         text = ''
         if self.d_ins:
@@ -92,104 +247,306 @@ class Adapter(object):
 
         return text
 
+    @property
+    def stats(self):
+        """Adapter-specific statistics for reporting to clients. Extend in child class."""
+        return {'state': self.state, 'reconnects': self.reconnects}
+
 
 class SimulationAdapter(Adapter):
     """A virtual rack that generates random data for all its inputs."""
-    def __init__(self):
-        super(SimulationAdapter, self).__init__()
+    def __init__(self, scan_interval=None):
+        super(SimulationAdapter, self).__init__(scan_interval=scan_interval)
 
     def read_all(self):
-        if self.d_ins:
-            for d in self.d_ins.values():
-                d.status = 0  # Healthy
-                d.val = choice([0, 1])
-        if self.a_ins:
-            for d in self.a_ins.values():
-                d.status = 0  # Healthy
-                d.val = uniform(0, d.full_scale)
-
-        sleep(0.01)  # Don't kill the browser by sending too much data
+        with self.lock:
+            if self.d_ins:
+                for d in self.d_ins.values():
+                    d.status = 0  # Healthy
+                    d.val = choice([0, 1])
+            if self.a_ins:
+                for d in self.a_ins.values():
+                    d.status = 0  # Healthy
+                    d.val = uniform(0, d.full_scale)
 
 
 class SoftwareAdapter(Adapter):
     """A virtual rack that is used for software devices."""
-    def __init__(self):
-        super(SoftwareAdapter, self).__init__()
+    def __init__(self, scan_interval=None):
+        super(SoftwareAdapter, self).__init__(scan_interval=scan_interval)
 
     def read_all(self):
-        for d in self.devices.values():
-            d.calc()
-        sleep(0.01)  # Don't kill the browser by sending too much data
+        with self.lock:
+            for d in self.devices.values():
+                d.calc()
 
     def write_all(self):
         pass
 
 
-class Beckhoff(Adapter):
-    """Beckhoff Modbus/TCP bus coupler (e.g. BK9000)"""
-    def __init__(self, ip_address):
-        super(Beckhoff, self).__init__(ip_address)
-        self.mb_client = ModbusClient(host=ip_address, timeout=5)
+class ModbusAdapter(Adapter):
+    """A generic Modbus/TCP device.
+
+    Inputs are read in blocks planned by update_io_image: devices close to each other are read in one request, while
+    large gaps in the address map and the protocol limits on the request size split the reads into several requests.
+    A scan sends all the read and write requests at once, so that it takes about one network round trip.
+
+    The data read goes straight into preallocated input images, which are decoded in one pass per scan. The input
+    devices are bound to the images and read their values from them on access. Analogue inputs with linear scaling
+    are scaled together by a BatchScaler when any of them is first read after a scan.
+
+    Inputs with a poll_interval are planned into separate blocks for each interval, which are only read when due.
+    Other inputs are read on every scan.
+
+    Only the outputs that have changed are written, except for a periodic refresh of all outputs, which also covers
+    any writes lost to a connection failure.
+
+    Adapters for the same host and port (e.g. several unit IDs behind a gateway) share one connection from a
+    ConnectionPool, taking turns to scan.
+    """
+    MBAP_HEADER_SIZE = 7  # Modbus/TCP application protocol header
+    MAX_READ_BITS = 2000  # Protocol limits on the number of inputs read per request
+    MAX_READ_REGISTERS = 125
+    MAX_WRITE_BITS = 1968  # Protocol limits on the number of outputs written per request
+    MAX_WRITE_REGISTERS = 123
+
+    description = 'Modbus/TCP device'  # For connection error messages
+    status_words = False  # Whether each analogue input has a status word before its value
+
+    def __init__(self, ip_address, scan_interval=None, max_bit_gap=256, max_register_gap=16, refresh_interval=1.0,
+                 port=502, unit_id=1, pool=None):
+        super(ModbusAdapter, self).__init__(ip_address, scan_interval)
+        self.pool = pool or connection_pool
+        self.mb_client = self.pool.client(ip_address, port, unit_id, timeout=5)
+        self.max_bit_gap = max_bit_gap  # Largest run of unused addresses that is read through rather than split
+        self.max_register_gap = max_register_gap
+        self.d_in_blocks = []  # Read requests for digital inputs: (start address, count, devices)
+        self.a_in_blocks = []
+        self.d_in_due = []  # Time when each block is next due to be read
+        self.a_in_due = []
+        self.d_in_read = []  # Indices of the blocks read in the current scan
+        self.a_in_read = []
+        self.d_in_image = BitImage([])
+        self.a_in_image = RegisterImage([])
+        self.scaler = None
+        self.refresh_interval = refresh_interval  # Time between writes of all outputs (s), whether changed or not
+        self.last_refresh = None  # Time of the last write of all outputs; None = due on the next scan
+        self.read_count = 0  # Number of read requests in the last scan
+        self.write_count = 0  # Number of write requests in the last scan
+        self.bytes_per_scan = 0  # Modbus/TCP bytes sent and received per scan, excluding TCP/IP overhead
+
+    def update_io_image(self):
+        super(ModbusAdapter, self).update_io_image()
+        self.d_in_blocks = plan_read_groups(self.d_ins.values(), self.MAX_READ_BITS, self.max_bit_gap)
+        self.a_in_blocks = plan_read_groups(self.a_ins.values(), self.MAX_READ_REGISTERS, self.max_register_gap)
+        self.d_in_due = [0.0] * len(self.d_in_blocks)
+        self.a_in_due = [0.0] * len(self.a_in_blocks)
+
+        # Bind each device to the block planned for it; blocks of different groups may overlap
+        self.d_in_image = BitImage(self.d_in_blocks)
+        for i, (_, _, devices) in enumerate(self.d_in_blocks):
+            for d in devices:
+                d.bind(self.d_in_image, self.d_in_image.index(d.address, i))
+
+        offset = 1 if self.status_words else 0  # Offset of the value from the device address
+        formats = {}  # Format of each value (key: address)
+        permutations = {}  # Byte order of values that need reordering (key: address)
+        for d in self.a_ins.values():
+            formats[d.address + offset] = d.raw_format
+            if d.codec is not None and not d.codec.standard:
+                permutations[d.address + offset] = d.codec.permutation
+        self.a_in_image = RegisterImage(self.a_in_blocks, formats, permutations)
+        scaled = []  # Devices to scale as a batch, with the indices of their raw values
+        for i, (_, _, devices) in enumerate(self.a_in_blocks):
+            for d in devices:
+                index = self.a_in_image.index(d.address + offset, i)
+                status_index = self.a_in_image.index(d.address, i) if self.status_words else None
+                d.bind(self.a_in_image, index, status_index)
+                if d.batch_scaled:
+                    scaled.append((d, index))
+        self.scaler = BatchScaler(self.a_in_image, scaled)
+
+        # Estimate the traffic of a scan with a full output refresh until the first scan. Read requests are 5 bytes
+        # long; responses are 2 bytes plus the data.
+        size = 0
+        for _, count, _ in self.d_in_blocks:
+            size += 2 * self.MBAP_HEADER_SIZE + 7 + int(ceil(count / 8.0))
+        for _, count, _ in self.a_in_blocks:
+            size += 2 * self.MBAP_HEADER_SIZE + 7 + 2 * count
+        # Write requests are 6 bytes long plus the data; responses are 5 bytes
+        for block in plan_writes(self.d_outs.values(), self.MAX_WRITE_BITS, refresh=True):
+            size += 2 * self.MBAP_HEADER_SIZE + 11 + int(ceil(len(block) / 8.0))
+        for block in plan_writes(self.a_outs.values(), self.MAX_WRITE_REGISTERS, refresh=True):
+            size += 2 * self.MBAP_HEADER_SIZE + 11 + 2 * sum(d.length for d in block)
+        self.bytes_per_scan = size
 
     def start(self):
-        while True:
-            self.mb_client.open()
-            if self.mb_client.is_open():
-                break
+        if not self.mb_client.open():
+            raise ConnectionError('Unable to connect to {} at {}'.format(self.description, self.ip_address))
 
-            print 'Unable to connect to Beckhoff rack at {}; retrying...'.format(self.ip_address)
-            sleep(1)
+        self.last_refresh = None  # The device may have reset its outputs while the connection was down
+        self.d_in_due = [0.0] * len(self.d_in_blocks)  # Read all inputs straight away
+        self.a_in_due = [0.0] * len(self.a_in_blocks)
 
     def stop(self):
         self.mb_client.close()
 
-    def read_all(self):
-        # print 'Read inputs'
-        if self.d_ins:
-            data = self.mb_client.read_discrete_inputs(self.d_in_range[0], self.d_in_range[1] - self.d_in_range[0] + 1)
-            if not data:
-                raise ConnectionError('No data received for DIns')
+    def transact(self, requests):
+        """Send a batch of Modbus requests and return their responses"""
+        try:
+            results = self.mb_client.transact(requests)
+        except (socket.error, modbus.ModbusError) as e:
+            raise ConnectionError('Modbus transaction with {} at {} failed: {}'.format(self.description,
+                                                                                      self.ip_address, e))
+        self.bytes_per_scan = self.mb_client.last_transaction_bytes
+        return results
+
+    @staticmethod
+    def _due_blocks(blocks, due_times, now):
+        """Indices of the blocks due to be read now. Schedules their next reads."""
+        due = []
+        for i, (_, _, devices) in enumerate(blocks):
+            if now >= due_times[i]:
+                due.append(i)
+                interval = devices[0].poll_interval  # The same for all devices in a block
+                if interval:
+                    due_times[i] += interval
+                    if due_times[i] <= now:  # Fell behind, e.g. after a reconnection; don't try to catch up
+                        due_times[i] = now + interval
+        return due
+
+    def read_requests(self):
+        """Requests for the input blocks that are due to be read, which read the data into the input images"""
+        now = monotonic()
+        self.d_in_read = self._due_blocks(self.d_in_blocks, self.d_in_due, now)
+        self.a_in_read = self._due_blocks(self.a_in_blocks, self.a_in_due, now)
+
+        requests = []
+        for i in self.d_in_read:
+            start, count, _ = self.d_in_blocks[i]
+            requests.append(modbus.read_discrete_inputs(start, count, self.d_in_image.views[i]))
+        for i in self.a_in_read:
+            start, count, _ = self.a_in_blocks[i]
+            requests.append(modbus.read_input_registers(start, count, self.a_in_image.views[i]))
+
+        self.read_count = len(requests)
+        return requests
+
+    def write_requests(self):
+        """Requests for writing the outputs that have changed since the last scan, or all outputs if a refresh is due"""
+        now = monotonic()
+        refresh = self.last_refresh is None or now - self.last_refresh >= self.refresh_interval
+        if refresh:
+            self.last_refresh = now
+
+        requests = []
+        for block in plan_writes(self.d_outs.values(), self.MAX_WRITE_BITS, refresh):
+            for d in block:
+                d.dirty = False  # Cleared before reading the value, so that a concurrent change is not lost
+            requests.append(modbus.write_multiple_coils(block[0].address, [d.raw for d in block]))
+
+        for block in plan_writes(self.a_outs.values(), self.MAX_WRITE_REGISTERS, refresh):
+            data = []
+            for d in block:
+                d.dirty = False
+                data += d.words
+            requests.append(modbus.write_multiple_registers(block[0].address, data))
 
-            i0 = self.d_in_range[0]  # Starting index for looking up values from the data list
-            for d in self.d_ins.values():
-                d.val = data[d.address - i0]
+        self.write_count = len(requests)
+        return requests
 
-        if self.a_ins:
-            # print '\tRead input registers', self.a_in_range[0], self.a_in_range[1] - self.a_in_range[0] + 1
-            data = self.mb_client.read_input_registers(self.a_in_range[0], self.a_in_range[1] - self.a_in_range[0] + 1)
-            if not data:
-                raise ConnectionError('No data received from AIns')
+    def _update_inputs(self):
+        """Decode the input images after a read, making the new values visible to the bound devices"""
+        if not self.d_in_read and not self.a_in_read:
+            return
+
+        d_values = self.d_in_image.decode()
+        a_values = self.a_in_image.decode(self.a_in_read)
+        with self.lock:
+            self.d_in_image.values = d_values
+            self.a_in_image.values = a_values
+            for i in self.d_in_read:
+                for d in self.d_in_blocks[i][2]:
+                    if d.log_length:
+                        d.log_reading()
+            for i in self.a_in_read:
+                for d in self.a_in_blocks[i][2]:
+                    if d.log_length:
+                        d.log_reading()
 
-            i0 = self.a_in_range[0]  # Starting index for looking up values from the data list
-            for d in self.a_ins.values():
-                d.status = data[d.address - i0]
-                d.val = data[d.address - i0 + 1]
+    def read_all(self):
+        self.transact(self.read_requests())
+        self._update_inputs()
 
     def write_all(self):
-        # print 'Write outputs'
-        if self.d_outs:
-            data = []
-            for i in xrange(self.d_out_range[0], self.d_out_range[1] + 1):
-                try:
-                    data.append(self.d_outs[i].raw)
-                except KeyError:
-                    data.append(0)  # Default value
+        self.transact(self.write_requests())
 
-            self.mb_client.write_multiple_coils(self.d_out_range[0], data)
+    def scan(self):
+        self.transact(self.read_requests() + self.write_requests())
+        self._update_inputs()
 
-        if self.a_outs:
-            data = []
-            for d in self.a_outs.values():
-                data.append(0)
-                data.append(d.raw)  # Only write to low words
+    def __repr__(self):
+        text = super(ModbusAdapter, self).__repr__()
+        text += '\tRead requests:\t\t' + str(len(self.d_in_blocks) + len(self.a_in_blocks))
+        text += '\t' + str(self.bytes_per_scan) + ' bytes per scan\n'
+        return text
+
+    @property
+    def stats(self):
+        stats = super(ModbusAdapter, self).stats
+        stats.update({'readRequests': self.read_count, 'writeRequests': self.write_count,
+                      'bytesPerScan': self.bytes_per_scan, 'sharedClients': self.mb_client.connection.clients})
+        return stats
 
-            self.mb_client.write_multiple_registers(self.a_out_range[0], data)
+
+class Beckhoff(ModbusAdapter):
+    """Beckhoff Modbus/TCP bus coupler (e.g. BK9000)"""
+    description = 'Beckhoff rack'
+    status_words = True
 
 
 class Netscanner(Adapter):
-    """Netscanner pressure brick"""
-    def __init__(self, ip_address):
-        super(Netscanner, self).__init__(ip_address)
+    """Netscanner pressure brick (e.g. 9116)
+
+    By default each scan polls the channels with an ASCII read command. With streaming=True, the Netscanner instead
+    streams binary frames of all channels autonomously at its own rate, and each scan processes all the frames
+    received since the previous one: every frame is logged with its own timestamp and the latest one sets the device
+    values.
+
+    The stream commands and frame layout are class attributes, so they can be matched to the instrument firmware.
+    Streaming has only been tested against the emulator (emulator.py); check them against the firmware before
+    enabling it on real hardware.
+    """
+    PORT = 9000
+    PSI_TO_MBAR = 68.947573
+    CHANNELS = 16
+
+    STREAM_START_CMD = 'c 01 {mask:04x} 7 {period} 1\n'  # Autonomous host stream 1, binary EU frames
+    STREAM_STOP_CMD = 'c 01 0\n'
+
+    MAX_FRAME_RATE = 500.0  # Fastest stream rate (Hz)
+    FRAME_TYPE = 0x0A  # Packet type of binary EU pressure frames
+    FRAME = struct.Struct('>IIIII16f')  # Packet type, frame number, serial number, time (s, ns), pressures (psi)
+    FRAME_HEADER_LENGTH = 5  # Number of header fields before the pressures
+
+    ASCII_READING_LENGTH = 12  # Characters per channel in replies to the ASCII read command
+
+    def __init__(self, ip_address, scan_interval=None, streaming=False, frame_period=0, timeout=5.0):
+        super(Netscanner, self).__init__(ip_address, scan_interval)
+        self.streaming = streaming
+        self.frame_period = frame_period  # Stream frame period (ms); 0 = the instrument's fastest rate
+        self.timeout = timeout  # Time without data before the connection is considered lost (s)
+        self.sock = None
+        self.buffer = bytearray()  # Received data not yet decoded
+        self.frame_time = None  # Timestamp of the latest frame, on the controller's monotonic clock
+        self.frames = 0  # Number of frames received since the connection was made
+        self.frames_lost = 0  # Number of frames missing from the frame number sequence
+        self.resyncs = 0  # Number of times invalid data was skipped to find the start of a frame
+        self._frame_type = struct.pack('>I', self.FRAME_TYPE)
+        self._frame_structs = {}  # Structs for decoding several frames at once (key: number of frames)
+        self._last_frame_number = None
+        self._clock_offset = None  # Difference between the controller's clock and the instrument's
+        self._last_data = None  # Time when data was last received
 
     def start(self):
         # Generate a list of transducers, sorted by address/offset (descending)
@@ -201,78 +558,163 @@ class Netscanner(Adapter):
             channel_mask |= 1 << device.address
         self.read_cmd = 'r{:04x}0'.format(channel_mask)
 
-        # Set up and connect to the Netscanner
+        del self.buffer[:]
+        self.frame_time = None
+        self.frames = 0
+        self._last_frame_number = None
+        self._clock_offset = None
+
+        # Set up and connect to the Netscanner, and start the stream of all channels
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.settimeout(5)
+        self.sock.settimeout(self.timeout)
+        try:
+            self.sock.connect((self.ip_address, self.PORT))
+            if self.streaming:
+                self.sock.sendall(self.STREAM_START_CMD.format(mask=(1 << self.CHANNELS) - 1,
+                                                               period=self.frame_period))
+        except socket.error:
+            self.sock.close()
+            self.sock = None
+            raise ConnectionError('Unable to connect to Netscanner at {}'.format(self.ip_address))
 
-        while True:
-            try:
-                self.sock.connect((self.ip_address, 9000))
-            except socket.error:
-                print 'Unable to connect to Netscanner at {}; retrying...'.format(self.ip_address)
-                sleep(1)
-            else:
-                break
+        self._last_data = monotonic()
 
     def stop(self):
+        if self.sock is None:
+            return
+        if self.streaming:
+            try:
+                self.sock.sendall(self.STREAM_STOP_CMD)
+            except socket.error:
+                pass
         self.sock.close()
+        self.sock = None
 
     def read_all(self):
-        self.sock.send(self.read_cmd)
+        if self.streaming:
+            self._read_stream()
+        else:
+            self._poll()
+
+    def _socket(self):
+        """The connected socket. stop() may close it from another thread at any time, after which using it raises
+        socket.error.
+        """
+        sock = self.sock
+        if sock is None:
+            raise ConnectionError('Not connected to Netscanner at {}'.format(self.ip_address))
+        return sock
+
+    def _receive(self, wait):
+        """Receive whatever data is available, waiting up to `wait` seconds for some to arrive"""
+        sock = self._socket()
         try:
-            data = self.sock.recv(1024)
-        except socket.timeout:
-            print 'Unable to read data from Netscanner at {}; retrying...'.format(self.ip_address)
-            return
-        except socket.error:
-            raise ConnectionError('Unable to read data from Netscanner at {}'.format(self.ip_address))
+            readable = select([sock], [], [], wait)[0]
+            while readable:
+                data = sock.recv(4096)
+                if not data:
+                    raise ConnectionError('Netscanner at {} closed the connection'.format(self.ip_address))
+                self.buffer += data
+                self._last_data = monotonic()
+                readable = select([sock], [], [], 0)[0]
+        except socket.error as e:
+            raise ConnectionError('Unable to read data from Netscanner at {}: {}'.format(self.ip_address, e))
+
+        if monotonic() - self._last_data > self.timeout:
+            raise ConnectionError('No data received from Netscanner at {} for {} s'.format(self.ip_address,
+                                                                                         self.timeout))
+
+    def _poll(self):
+        """Read the transducers with an ASCII read command, reassembling replies split across several packets"""
+        sock = self._socket()
+        try:
+            sock.sendall(self.read_cmd)
+        except socket.error as e:
+            raise ConnectionError('Unable to send command to Netscanner at {}: {}'.format(self.ip_address, e))
 
-        # Extract transducer readings
-        for i, device in enumerate(self.transducers):
-            start = i * 12  # Start index
-            reading = float(data[start:start + 12]) * 68.947573  # Convert psi to mbar
-            device.val = reading
+        length = len(self.transducers) * self.ASCII_READING_LENGTH
+        while len(self.buffer) < length:
+            self._receive(self.timeout)
+        data = str(self.buffer[:length])
+        del self.buffer[:length]
 
+        # Extract transducer readings
+        with self.lock:
+            for i, device in enumerate(self.transducers):
+                start = i * self.ASCII_READING_LENGTH  # Start index
+                reading = float(data[start:start + self.ASCII_READING_LENGTH]) * self.PSI_TO_MBAR
+                device.val = reading
+
+    def _read_stream(self):
+        """Decode all complete frames received since the last scan"""
+        self._receive(0)
+
+        # Skip any data before the start of the first frame, e.g. after a partial frame or a command reply
+        start = self.buffer.find(self._frame_type)
+        if start != 0:
+            if start < 0:
+                start = max(len(self.buffer) - len(self._frame_type) + 1, 0)
+            if start:
+                self.resyncs += 1
+                del self.buffer[:start]
+
+        # Count the complete frames; a frame not starting with the frame type is left for resynchronisation next time
+        size = self.FRAME.size
+        n = 0
+        while len(self.buffer) >= (n + 1) * size and self.buffer[n * size:n * size + 4] == self._frame_type:
+            n += 1
+        if not n:
+            return
 
-class Alicat(Adapter):
+        # Decode all the frames in one go; fields[i::stride] is field i of every frame
+        try:
+            frame_struct = self._frame_structs[n]
+        except KeyError:
+            frame_struct = self._frame_structs[n] = struct.Struct('>' + self.FRAME.format[1:] * n)
+        fields = frame_struct.unpack_from(self.buffer)
+        del self.buffer[:frame_struct.size]
+
+        stride = self.FRAME_HEADER_LENGTH + self.CHANNELS  # Fields per frame
+        frame_numbers = fields[1::stride]
+        times = self._frame_times(fields[3::stride], fields[4::stride])
+        if self._last_frame_number is not None:
+            self.frames_lost += (frame_numbers[0] - self._last_frame_number - 1) & 0xFFFFFFFF
+        self.frames_lost += sum((b - a - 1) & 0xFFFFFFFF for a, b in zip(frame_numbers, frame_numbers[1:]))
+        self._last_frame_number = frame_numbers[-1]
+        self.frames += n
+
+        channels = [array.array('d', fields[self.FRAME_HEADER_LENGTH + c::stride]) for c in xrange(self.CHANNELS)]
+        with self.lock:
+            for device in self.transducers:
+                readings = channels[device.address]
+                for t, reading in zip(times, readings):
+                    device.raw = reading * self.PSI_TO_MBAR
+                    device.log_reading(t)
+            self.frame_time = times[-1]
+
+    @property
+    def sample_rate(self):
+        if not self.streaming:
+            return super(Netscanner, self).sample_rate
+        return 1000.0 / self.frame_period if self.frame_period else self.MAX_FRAME_RATE
+
+    def _frame_times(self, seconds, nanoseconds):
+        """Convert frame timestamps from the instrument's clock to the controller's monotonic clock"""
+        times = [s + ns * 1e-9 for s, ns in zip(seconds, nanoseconds)]
+        now = monotonic()
+        # Anchor the clocks to the newest frame, which has only just arrived, and re-anchor if they drift apart
+        if self._clock_offset is None or abs(times[-1] + self._clock_offset - now) > 1.0:
+            self._clock_offset = now - times[-1]
+        return [t + self._clock_offset for t in times]
+
+    @property
+    def stats(self):
+        stats = super(Netscanner, self).stats
+        if self.streaming:
+            stats.update({'frames': self.frames, 'framesLost': self.frames_lost, 'resyncs': self.resyncs})
+        return stats
+
+
+class Alicat(ModbusAdapter):
     """Alicat device (e.g. pressure controller) with a Modbus/TCP interface"""
-    def __init__(self, ip_address):
-        super(Alicat, self).__init__(ip_address)
-        self.mb_client = ModbusClient(host=ip_address, timeout=5)
-
-    def start(self):
-        while True:
-            self.mb_client.open()
-            if self.mb_client.is_open():
-                break
-
-            print 'Unable to connect to Alicat device at {}; retrying...'.format(self.ip_address)
-            sleep(1)
-
-    def stop(self):
-        self.mb_client.close()
-
-    def read_all(self):
-        if self.a_ins:
-            data = self.mb_client.read_input_registers(self.a_in_range[0], self.a_in_range[1] - self.a_in_range[0] + 1)
-            if not data:
-                raise ConnectionError
-
-            i0 = self.a_in_range[0]  # Starting index for looking up values from the data list
-            for d in self.a_ins.values():
-                if d.length == 2:
-                    d.val = data[d.address - i0:d.address - i0 + 2]
-                elif d.length == 1:
-                    d.val = data[d.address - i0]
-
-    def write_all(self):
-        # print 'Write outputs'
-        if self.a_outs:
-            data = []
-            for d in self.a_outs.values():
-                if d.length == 2:
-                    data += d.raw_array
-                elif d.length == 1:
-                    data.append(d.raw_array)
-
-            self.mb_client.write_multiple_registers(self.a_out_range[0], data)
+    description = 'Alicat device'
@@ -0,0 +1,107 @@
+import struct
+import threading
+from collections import OrderedDict
+from math import ceil
+from numbers import Number
+from time import time
+
+from ringbuffer import RingBuffer
+from timing import monotonic
+
+CAPTURE_MAGIC = 'CAPT'
+CAPTURE_HEADER = struct.Struct('<4sHd')  # Magic, tag count, time of the first sample (s since the epoch)
+TAG_HEADER = struct.Struct('<HI')  # Tag length, sample count
+
+
+class Capture(object):
+    """A routine's own recording of a set of devices, sampled by the controller on every cycle of the main loop.
+
+    Each device has a preallocated RingBuffer. As with device logs, samples older than `length` seconds are
+    discarded, so the statistics cover a sliding window; unlike device logs, the window belongs to the routine alone,
+    so it is not affected by other routines or by what the clients stream. Only healthy numeric readings are recorded.
+    """
+    def __init__(self, devices, length, sample_rate, headroom=1.25):
+        """devices: dictionary of the devices to record (key: name used in the capture, e.g. the tag)"""
+        self.devices = OrderedDict(sorted(devices.items()))
+        self.sample_rate = sample_rate  # Rate at which sample() is called (Hz), for sizing the buffers
+        self.headroom = headroom  # Extra buffer capacity to allow for cycle jitter
+        self.buffers = OrderedDict((name, RingBuffer(0)) for name in self.devices)
+        self.lock = threading.Lock()  # Held while sampling, so that the statistics are consistent
+        self.length = length
+
+    @property
+    def length(self):
+        """Time span of the capture (s)"""
+        return self._length
+
+    @length.setter
+    def length(self, value):
+        with self.lock:
+            self._length = value
+            capacity = int(ceil(value * self.sample_rate * self.headroom)) + 1
+            for buf in self.buffers.values():
+                if capacity > buf.capacity:
+                    buf.resize(capacity)
+
+    def sample(self, t=None):
+        """Record the current reading of every device, timestamped t (default: now)"""
+        if t is None:
+            t = monotonic()
+        with self.lock:
+            for name, device in self.devices.items():
+                value = device.val
+                if isinstance(value, Number) and device.healthy:
+                    buf = self.buffers[name]
+                    buf.append(t, value)
+                    buf.discard_older_than(t - self._length)
+
+    def clear(self):
+        with self.lock:
+            for buf in self.buffers.values():
+                buf.clear()
+
+    def count(self, name):
+        return len(self.buffers[name])
+
+    def mean(self, name):
+        """Mean of the recorded values; the device's current value if there are none, as with Device.log_average"""
+        with self.lock:
+            buf = self.buffers[name]
+            if not len(buf):
+                return self.devices[name].val
+            return buf.mean()
+
+    def stddev(self, name):
+        """Population standard deviation of the recorded values"""
+        with self.lock:
+            buf = self.buffers[name]
+            if len(buf) < 2:
+                return 0
+            return buf.pvariance() ** 0.5
+
+    def gradient(self, name):
+        """Difference between the means of the newer and older halves of the recorded values"""
+        with self.lock:
+            buf = self.buffers[name]
+            if len(buf) < 2:
+                return 0
+            mean_1, mean_2 = buf.half_means()
+            return mean_2 - mean_1
+
+    def export(self):
+        """Recorded samples in a compact binary format (little-endian):
+            CAPTURE_HEADER: 'CAPT', tag count, time of the first sample (float64, s since the epoch)
+            For each tag: TAG_HEADER (tag length, sample count), tag (UTF-8), sample times (float32, s after the first
+            sample), values (float32)
+        """
+        with self.lock:
+            starts = [buf[0][0] for buf in self.buffers.values() if len(buf)]
+            start = min(starts) if starts else monotonic()
+            parts = [CAPTURE_HEADER.pack(CAPTURE_MAGIC, len(self.buffers), time() - (monotonic() - start))]
+            for name, buf in self.buffers.items():
+                tag = name.encode('utf-8')
+                n = len(buf)
+                parts.append(TAG_HEADER.pack(len(tag), n) + tag)
+                parts.append(struct.pack('<{}f'.format(n), *[t - start for t in buf.window(times=True)]))
+                parts.append(struct.pack('<{}f'.format(n), *buf.window()))
+        return ''.join(parts)
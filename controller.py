@@ -1,6 +1,11 @@
 import json
 import thread
+import threading
 import urllib2
+from contextlib import contextmanager
+from itertools import count
+from time import time, sleep
+from traceback import print_exc
 
 import routines
 from devices import DIn, DOut
@@ -9,23 +14,54 @@ from devices import AOut, AOutStatus, AOutFloat
 from devices import InputDevice, LagDevice, RampDevice, PIDDevice, OutputDevice
 from adapters import Beckhoff, Netscanner, Alicat, SimulationAdapter, SoftwareAdapter
 from adapters import ConnectionError
+from capture import Capture
+from emulator import Emulator
+from historian import Historian, HistoryReader
+from scheduler import RoutineScheduler
+from streaming import DeltaStream, StreamAggregator, StreamFrames, BinaryFrameEncoder
+from timing import CycleTimer, monotonic
 
 
 class Controller(object):
     """Modbus device controller. Executes routines and reads/writes IO devices."""
-    def __init__(self, simulation=False, new_thread=True):
+    MAX_HISTORY_POINTS = 10000  # Most buckets returned by a history query
+    CYCLE_WAIT_TIMEOUT = 5  # Longest wait in wait_cycle(), in cycle times
+
+    def __init__(self, simulation=False, new_thread=True, cycle_time=0.01, emulation=None, history_dir='history'):
         self.simulation = simulation  # Simulation mode - randomly generated data
+        self.emulator = None  # Local emulation of the remote IO; enabled by passing Emulator arguments as emulation
+        self.historian = None  # Records every cycle's device values under history_dir; not used in simulation mode
+        self.history_reader = None
         self.new_thread = new_thread  # Whether to start a new thread for the main loop
+        self.cycle_time = cycle_time  # Period of the main loop (s); also the default scan interval for adapters
+        self.timer = CycleTimer(cycle_time)  # Paces the main loop and records its jitter and overruns
+        self.encode_time = 0.0  # Time spent serialising and queueing websocket data in the most recent cycle (s)
+        self.max_encode_time = 0.0
+        self._running = False
+        self._stopping = threading.Event()  # Set by stop(), to wake up adapter threads waiting to reconnect
+        self._cycle_done = threading.Condition()  # Notified after each cycle's snapshot of the IO, and by wake()
+        self.cycles_done = 0  # Number of cycles whose snapshot has been taken
 
         self.routine_classes = {}  # Classes of available routines (key: name, value: class)
-        self.routines = {}  # Running routines (key: name, value: Routine object)
+        self.routines = {}  # Running routines (key: instance ID, value: Routine object)
+        self.scheduler = RoutineScheduler(self)  # Runs the routines that are coroutines, all on one thread
+        self._routine_ids = count(1)
         self.devices = {}  # Dictionary of all devices (key: tag name, value: Device object)
-        self.adapters = []  # List of IO adapters to be scanned in the main loop
-        self.clients = []  # List of Websocket clients
+        self.adapters = []  # List of IO adapters, each scanned in its own thread
+        self.clients = ()  # Websocket clients. Replaced rather than modified, so it can be read without locking.
+        self._clients_lock = threading.Lock()  # Serialises changes to self.clients
+        self.captures = ()  # Capture sessions opened by routines, sampled every cycle. Replaced like self.clients.
+        self._captures_lock = threading.Lock()  # Serialises changes to self.captures
+        self.delta_streams = {}  # Change tracking for clients using delta streaming (key: stream_select, value: DeltaStream)
+        self.aggregators = {}  # Aggregates for rate-limited clients (key: (stream_select, period), value: StreamAggregator)
+        self.tag_table = []  # Order of the device values in binary stream frames
+        self.binary_encoders = {}  # Binary data frame encoders (key: whether to use float32, value: BinaryFrameEncoder)
+        self.plot_encoders = {}  # Binary plot frame encoders (key: tuple of plot data keys, value: BinaryFrameEncoder)
 
         # E-stop relay status indication flags
         self.estop_status = True  # True = not triggered
         self.estop_prev_status = self.estop_status  # Used for detecting state changes
+        self.estop_read = False  # Whether the E-stop input has been read since the controller started
 
         ############ EDIT THE LINES BELOW TO CONFIGURE THE IO TREE ############
         beckhoff = Beckhoff('192.168.100.20')
@@ -49,7 +85,7 @@ class Controller(object):
         beckhoff.add_device(AOutStatus('Flow controller 2.SP', 2082, scale_from=(0, 30000), scale_to=(0, 2.6666)))
         beckhoff.add_device(AOutStatus('Flow controller 3.SP', 2084, scale_from=(0, 32600), scale_to=(0, 1.0991)))
 
-        beckhoff.add_device(AInStatus('Thermocouple', 40, scale_from=(0, 10), scale_to=(0, 1)))
+        beckhoff.add_device(AInStatus('Thermocouple', 40, scale_from=(0, 10), scale_to=(0, 1), poll_interval=1.0))
         self._add_adapter(beckhoff)
 
         netscanner = Netscanner('192.168.100.30')
@@ -100,26 +136,40 @@ class Controller(object):
 
         ############ END IO TREE ############
 
+        if emulation is not None and not self.simulation:
+            self.emulator = Emulator(self.adapters, **emulation)
+
         # Get calibration parameters from the database
         self._get_cal_parameters()
 
+        # Set up binary streaming for the finished IO tree. The tag table uses the controller's device keys, but the
+        # stream data is keyed by each device's own tag.
+        self.tag_table = sorted(self.devices.keys())
+        device_tags = [self.devices[tag].tag for tag in self.tag_table]
+        for float32 in (False, True):
+            self.binary_encoders[float32] = BinaryFrameEncoder(BinaryFrameEncoder.KIND_DATA, device_tags, float32)
+
+        if history_dir and not self.simulation:
+            self.historian = Historian(history_dir, self.tag_table)
+            self.history_reader = HistoryReader(history_dir)
+
         # Configure routines
         self._add_routines()
 
     def _add_adapter(self, adapter):
         # If the controller is in simulation mode, replace the adapter with one that generates random readings for its inputs
         if self.simulation and not isinstance(adapter, SoftwareAdapter):
-            sim_adapter = SimulationAdapter()
+            sim_adapter = SimulationAdapter(adapter.scan_interval)
             for device in adapter.devices.values():
                 # Create a new, simplified device
                 if isinstance(device, DIn):
-                    sim_device = DIn(device.tag, device.address, device.scale_from, device.scale_to, device.full_scale, device.log_length)
+                    sim_device = DIn(device.tag, device.address, device.scale_from, device.scale_to, device.full_scale, device.log_length, device.deadband)
                 elif isinstance(device, DOut):
-                    sim_device = DOut(device.tag, device.address, device.scale_from, device.scale_to, device.full_scale, device.log_length)
+                    sim_device = DOut(device.tag, device.address, device.scale_from, device.scale_to, device.full_scale, device.log_length, device.deadband)
                 elif isinstance(device, AIn):
-                    sim_device = AIn(device.tag, device.address, device.scale_from, device.scale_to, device.full_scale, device.log_length)
+                    sim_device = AIn(device.tag, device.address, device.scale_from, device.scale_to, device.full_scale, device.log_length, device.deadband)
                 elif isinstance(device, AOut):
-                    sim_device = AOut(device.tag, device.address, device.scale_from, device.scale_to, device.full_scale, device.log_length)
+                    sim_device = AOut(device.tag, device.address, device.scale_from, device.scale_to, device.full_scale, device.log_length, device.deadband)
                 else:  # E.g. a software device
                     sim_device = device
 
@@ -127,6 +177,10 @@ class Controller(object):
 
             adapter = sim_adapter
 
+        if adapter.scan_interval is None:
+            adapter.scan_interval = self.cycle_time
+        for device in adapter.devices.values():
+            device.set_sample_rate(adapter.sample_rate)
         adapter.update_io_image()
         self.devices.update(adapter.devices)
         self.adapters.append(adapter)
@@ -181,18 +235,71 @@ class Controller(object):
             self.error_message(e)
             return
 
-        print 'Starting routine', name
-        thread.start_new_thread(routine.run, ())
-        self.routines[name] = routine
-
-    def stop_routine(self, name):
-        self.routines[name].stop()
-
-    def pause_routine(self, name):
-        self.routines[name].pause()
-
-    def resume_routine(self, name):
-        self.routines[name].resume()
+        routine.id = '{}#{}'.format(name, next(self._routine_ids))
+        self.routines[routine.id] = routine
+        print 'Starting routine', routine.id
+        if routine.coroutine:
+            self.scheduler.add(routine)
+        else:
+            thread.start_new_thread(routine.run, ())
+        return routine.id
+
+    def _find_routines(self, key):
+        """The running routine with the given instance ID, or all running instances of the routine with the given name"""
+        if key in self.routines:
+            return [self.routines[key]]
+        return [routine for routine in self.routines.values() if routine.name == key]
+
+    def stop_routine(self, key):
+        for routine in self._find_routines(key):
+            routine.stop()
+
+    def pause_routine(self, key):
+        for routine in self._find_routines(key):
+            routine.pause()
+
+    def resume_routine(self, key):
+        for routine in self._find_routines(key):
+            routine.resume()
+
+    def wait_cycle(self, cycle=None):
+        """Block until the main loop has taken its snapshot of the IO in a cycle after the given one (default: the
+        current one), or until wake() is called. Returns the number of the latest cycle.
+
+        Gives up after a few cycle times, so that the caller can check its stop and pause flags even if the main loop
+        has stalled or died; callers wait in a loop anyway.
+        """
+        if not self._running:
+            sleep(self.cycle_time)  # No cycles to wait for
+            return self.cycles_done
+        with self._cycle_done:
+            if cycle is None or cycle == self.cycles_done:
+                self._cycle_done.wait(self.CYCLE_WAIT_TIMEOUT * self.cycle_time)
+            return self.cycles_done
+
+    def wake(self):
+        """Wake up everything waiting in wait_cycle(), e.g. for a routine to react to a stop request"""
+        with self._cycle_done:
+            self._cycle_done.notify_all()
+
+    def add_client(self, client):
+        with self._clients_lock:
+            self.clients = self.clients + (client,)
+
+    def remove_client(self, client):
+        with self._clients_lock:
+            self.clients = tuple(c for c in self.clients if c is not client)
+
+    def open_capture(self, devices, length):
+        """Start recording the given devices (key: name in the capture) on every cycle; see Capture"""
+        capture = Capture(devices, length, 1.0 / self.cycle_time)
+        with self._captures_lock:
+            self.captures = self.captures + (capture,)
+        return capture
+
+    def close_capture(self, capture):
+        with self._captures_lock:
+            self.captures = tuple(c for c in self.captures if c is not capture)
 
     def status_message(self, msg, colour=None):
         for client in self.clients:
@@ -216,9 +323,19 @@ class Controller(object):
 
     def start(self):
         self._running = True
-        print 'Connecting to remote devices...'
+        self._stopping.clear()
+        if self.emulator:
+            self.emulator.start()
+        if self.historian:
+            self.historian.start()
+        self.scheduler.start()
+
+        print 'Starting adapter scan threads'
+        self.estop_read = False
         for adapter in self.adapters:
-            adapter.start()
+            adapter.timer = CycleTimer(adapter.scan_interval)
+            adapter.set_stale(True)  # No readings until the adapter has connected and completed a scan
+            thread.start_new_thread(self._adapter_loop, (adapter,))
 
         print 'Starting main loop'
         if self.new_thread:
@@ -228,55 +345,240 @@ class Controller(object):
 
     def stop(self):
         self._running = False
+        self._stopping.set()  # Cut short any reconnection delays
+        for routine in self.routines.values():
+            routine.stop()
+        self.wake()
         for adapter in self.adapters:
             adapter.stop()
-
-    def _main_loop(self):
-        reset = False  # Restart loop after stopping
+        if self.emulator:
+            self.emulator.stop()
+        if self.historian:
+            self.historian.stop()
+
+    @contextmanager
+    def _adapters_locked(self):
+        """Prevent all adapters from updating their devices, e.g. while taking a consistent snapshot of the IO tree"""
+        for adapter in self.adapters:  # Always acquire in the same order to avoid deadlocks
+            adapter.lock.acquire()
+        try:
+            yield
+        finally:
+            for adapter in reversed(self.adapters):
+                adapter.lock.release()
+
+    def _adapter_loop(self, adapter):
+        """Connect to and scan a single adapter at its own rate, so that a slow or disconnected device does not hold up
+        the others. The connection is retried in this thread with an increasing delay until it succeeds.
+        """
         while self._running:
-            # Read all inputs
+            if not adapter.connected:
+                delay = adapter.connect()
+                if delay:
+                    self._stopping.wait(delay)
+                    continue
+                adapter.timer.start()  # Don't count the connection time as an overrun
+
             try:
-                for adapter in self.adapters:
-                    adapter.read_all()
+                adapter.scan()
             except ConnectionError:
-                print 'Connection error in main loop. Restarting...'
-                reset = True
-                break
-
-            # Send E-stop relay status, if it has changed
-            self.estop_status = self.devices['E-stop'].val
-            if not self.estop_status and self.estop_prev_status:  # Turned on
-                self.control_message('estop on')
-            elif self.estop_status and not self.estop_prev_status:  # Turned off
-                self.control_message('estop off')
-            self.estop_prev_status = self.estop_status
-
-            # Send the requested data to each websocket client
-            for client in self.clients:
-                # Readings from all devices
-                if client.stream_enabled:
-                    if client.stream_select == client.DATA_RAW:
-                        data = {device.tag: device.raw for device in self.devices.values()}
-                    elif client.stream_select == client.DATA_AVG:
-                        data = {device.tag: device.log_average for device in self.devices.values()}
-                    elif client.stream_select == client.DATA_STDDEV:
-                        data = {device.tag: device.log_stddev for device in self.devices.values()}
-                    else:
-                        data = {device.tag: device.val_status for device in self.devices.values()}
-
-                    client.send_data(data)
-
-                # Data to be plotted from each routine
-                if client.plot_enabled:
-                    for routine in self.routines.values():
-                        client.send_plot(routine.plot_data)
-
-            # Write all outputs
-            for adapter in self.adapters:
-                adapter.write_all()
-
-        if reset:
-            self.start()
+                print 'Connection error on adapter {} at {}. Reconnecting...'.format(type(adapter), adapter.ip_address)
+                adapter.disconnect()
+                continue
+            except Exception:
+                # E.g. a malformed reply. Don't trust the connection or the device values, and back off before
+                # reconnecting in case the fault persists.
+                print 'Error scanning adapter {} at {}:'.format(type(adapter), adapter.ip_address)
+                print_exc()
+                adapter.disconnect()
+                self._stopping.wait(adapter.backoff())
+                continue
+
+            adapter.online()
+            adapter.timer.wait()
+
+    def history(self, tag, start, end, max_points):
+        """Recorded values of a device between start and end (ms since the epoch, as in the user interface),
+        downsampled to at most max_points buckets for plotting. Each point is [bucket start time (ms), min, max, mean].
+        """
+        if self.history_reader is None:
+            raise ValueError('History is not being recorded')
+
+        max_points = min(max_points, self.MAX_HISTORY_POINTS)
+        resolution, buckets = self.history_reader.query(tag, start / 1000.0, end / 1000.0, max_points)
+        points = [[t * 1000, minimum, maximum, mean] for t, minimum, maximum, mean in buckets]
+        return {'tag': tag, 'from': start, 'to': end, 'resolution': resolution, 'points': points}
+
+    @property
+    def scan_stats(self):
+        """Timing statistics of the main loop and each adapter's scan thread"""
+        stats = {'main': self.timer.stats, 'adapters': []}
+        stats['main'].update({'encodeTime': self.encode_time * 1000, 'maxEncodeTime': self.max_encode_time * 1000})
+        if self.historian:
+            stats['historian'] = self.historian.stats
+        stats['scheduler'] = self.scheduler.stats
+        for adapter in self.adapters:
+            if adapter.timer:
+                adapter_stats = {'type': type(adapter).__name__, 'ip': adapter.ip_address}
+                adapter_stats.update(adapter.timer.stats)
+                adapter_stats.update(adapter.stats)
+                stats['adapters'].append(adapter_stats)
+        return stats
+
+    def _stream_data(self, client):
+        """Readings from all devices, in the form selected by the client"""
+        if client.stream_select == client.DATA_RAW:
+            # The values before scaling, i.e. the register values, or the decoded floats for float devices
+            return {device.tag: device.raw for device in self.devices.values()}
+        elif client.stream_select == client.DATA_AVG:
+            return {device.tag: device.log_average for device in self.devices.values()}
+        elif client.stream_select == client.DATA_STDDEV:
+            return {device.tag: device.log_stddev for device in self.devices.values()}
+        else:
+            return {device.tag: device.val_status for device in self.devices.values()}
+
+    @staticmethod
+    def _encode(data):
+        """Serialise websocket message data. ASCII-only JSON, so the result can be sent as a text frame as is."""
+        return json.dumps(data, separators=(',', ':'))
+
+    def _stream_to_client(self, client, frames, t):
+        """Send the data for the current cycle to a client, subject to its update rate and outbound queue length"""
+        variant = client.stream_select
+
+        # Keep track of all the changes since the client's last delta message, in case this cycle is skipped
+        changes_shared = False  # Whether the pending changes are just this cycle's, which all delta clients share
+        if client.stream_delta and not client.keyframe_required:
+            if frames.keyframes[variant]:
+                client.keyframe_required = True
+            elif frames.changes[variant]:
+                changes_shared = not client.pending_changes
+                client.pending_changes.update(frames.changes[variant])
+
+        # Decimate to the requested update rate
+        if client.stream_period:
+            window = int(t / client.stream_period)
+            if window == client.stream_window:
+                return
+
+        # If the client isn't keeping up, drop this frame. The latest data is sent once the queue has drained.
+        if client.backlogged:
+            client.dropped_frames += 1
+            return
+
+        if client.stream_binary:
+            client.send_encoded(frames.packed(variant, self.binary_encoders[client.binary_float32]), binary=True)
+        elif client.stream_aggregate:
+            if (variant, client.stream_period) not in frames.aggregates:
+                return  # The first aggregation window hasn't completed yet
+            client.send_encoded('agg ' + frames.encoded('aggregates', (variant, client.stream_period)))
+        elif not client.stream_delta:
+            client.send_encoded('data ' + frames.encoded('streams', variant))
+        elif client.keyframe_required:
+            client.send_delta(frames.encoded('streams', variant), keyframe=True)
+        elif changes_shared:
+            client.send_delta(frames.encoded('changes', variant))
+        elif client.pending_changes:
+            client.send_delta(self._encode(client.pending_changes))
+
+        if client.stream_period:
+            client.stream_window = window
+
+    def _pack_plot(self, data):
+        """Pack routine plot data into a binary frame. Returns the plot data keys and the frame."""
+        keys = tuple(sorted(data.keys()))
+        try:
+            encoder = self.plot_encoders[keys]
+        except KeyError:
+            encoder = self.plot_encoders[keys] = BinaryFrameEncoder(BinaryFrameEncoder.KIND_PLOT, keys)
+        return keys, encoder.pack(data, self.timer.cycles)
+
+    def _main_loop(self):
+        self.timer.start()
+        while self._running:
+            clients = self.clients
+            streams = {}  # Data for each stream variant requested by at least one client (key: stream_select)
+            plots = []  # Plot data from each routine, if requested by at least one client
+            with self._adapters_locked():
+                # Send E-stop relay status, if it has changed. Until the input has first been read, its status is
+                # unknown and not reported; once it has, losing the connection counts as the E-stop being triggered.
+                estop = self.devices['E-stop']
+                if not estop.stale:
+                    self.estop_read = True
+                    self.estop_status = estop.val
+                elif self.estop_read:
+                    self.estop_status = False
+                if not self.estop_status and self.estop_prev_status:  # Turned on
+                    self.control_message('estop on')
+                elif self.estop_status and not self.estop_prev_status:  # Turned off
+                    self.control_message('estop off')
+                self.estop_prev_status = self.estop_status
+
+                # Collect the data requested by the websocket clients, once per variant
+                for client in clients:
+                    if client.stream_enabled and client.stream_select not in streams:
+                        streams[client.stream_select] = self._stream_data(client)
+
+                if any(client.plot_enabled for client in clients):
+                    plots = [routine.plot_data for routine in self.routines.values()]
+
+                if self.historian:
+                    history = [self.devices[tag].val_status for tag in self.tag_table]
+
+                now = monotonic()
+                for capture in self.captures:
+                    capture.sample(now)
+
+            # Let the routines evaluate their conditions on the fresh values
+            with self._cycle_done:
+                self.cycles_done += 1
+                self._cycle_done.notify_all()
+
+            if self.historian:
+                self.historian.record(time(), history)
+
+            # Serialise each message once and send the same encoded frame to all clients that requested it
+            t = monotonic()
+            frames = StreamFrames(streams, self._encode, self.timer.cycles)
+            plot_msgs = ['plot ' + self._encode(data) for data in plots]
+            plot_frames = []
+            if any(client.plot_enabled and client.stream_binary for client in clients):
+                plot_frames = [self._pack_plot(data) for data in plots]
+            stream_clients = [client for client in clients if client.stream_enabled]
+
+            # Work out the changes since the previous cycle for the variants streamed to delta clients
+            for variant in set(client.stream_select for client in stream_clients if client.stream_delta):
+                delta_stream = self.delta_streams.setdefault(variant, DeltaStream(self.devices))
+                frames.keyframes[variant], frames.changes[variant] = delta_stream.update(streams[variant], t)
+
+            # Update the min/max/mean aggregates for clients receiving them at a limited rate
+            aggregator_keys = set((client.stream_select, client.stream_period) for client in stream_clients
+                                  if client.stream_aggregate)
+            self.aggregators = {key: self.aggregators.get(key) or StreamAggregator(key[1]) for key in aggregator_keys}
+            for (variant, period), aggregator in self.aggregators.items():
+                aggregator.add(streams[variant], t)
+                if aggregator.result:
+                    frames.aggregates[variant, period] = aggregator.result
+
+            for client in stream_clients:
+                self._stream_to_client(client, frames, t)
+
+            for client in clients:
+                if not client.plot_enabled or client.backlogged:
+                    continue
+                if client.stream_binary:
+                    for keys, frame in plot_frames:
+                        if keys != client.plot_tags:  # Send the order of the values before the first frame
+                            client.send_plot_tags(keys)
+                        client.send_encoded(frame, binary=True)
+                else:
+                    for msg in plot_msgs:
+                        client.send_encoded(msg)
+
+            self.encode_time = monotonic() - t
+            self.max_encode_time = max(self.max_encode_time, self.encode_time)
+
+            self.timer.wait()  # Sleep until the start of the next cycle
 
 
 def main():
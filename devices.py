@@ -1,20 +1,10 @@
-from time import time
-import struct
-import array
 import ctypes
+from math import ceil
 from random import uniform
 
-
-def mean(data):
-    """Return the sample arithmetic mean of data."""
-    return sum(data) / float(len(data))
-
-
-def ss(data):
-    """Return sum of square deviations of sequence data."""
-    c = mean(data)
-    ss = sum((x - c) ** 2 for x in data)
-    return ss
+from floatcodec import FloatCodec
+from ringbuffer import RingBuffer
+from timing import monotonic
 
 
 class Device(object):
@@ -26,15 +16,27 @@ class Device(object):
     STATUS_OC = 0x42  # Open circuit (thermocouple)
 
     length = 1  # Length of data structure, in bytes
-
-    def __init__(self, tag, address, scale_from=(0, 0x7FFF), scale_to=(4.0, 20.0), full_scale=None, log_length=0):
+    sample_rate = 100.0  # Expected rate of new readings (Hz), used for sizing the log buffer
+    log_headroom = 1.25  # Extra log buffer capacity to allow for scan jitter
+    deadband = 0  # Minimum change in value for the device to be included in delta stream updates
+    poll_interval = None
+    raw_format = 'H'  # Struct format of the raw value in an input image (see bind)
+    codec = None  # FloatCodec for values spanning two registers
+    stale = False  # Set while the device's adapter is disconnected, so its value is out of date
+
+    _image = None  # Input image that the raw value and status are read from; None = stored in the device
+    _scaler = None  # BatchScaler that calculates the scaled value; None = calculated by the device
+
+    def __init__(self, tag, address, scale_from=(0, 0x7FFF), scale_to=(4.0, 20.0), full_scale=None, log_length=0, deadband=0,
+                 poll_interval=None):
         self.tag = tag  # Tag name
         self.address = address  # Usually Modbus offset
+        self.deadband = deadband
+        self.poll_interval = poll_interval  # Minimum time between reads of an input (s); None = read on every scan
 
-        self.scale_from = scale_from
-        self.scale_to = scale_to
-        self.scale_from_span = scale_from[1] - scale_from[0]
-        self.scale_to_span = scale_to[1] - scale_to[0]
+        self._scale_from = scale_from
+        self._scale_to = scale_to
+        self._update_scaling()
 
         if full_scale is None:
             self.full_scale = scale_to[1]
@@ -45,7 +47,71 @@ class Device(object):
         self.raw = 0  # Raw, unscaled value
 
         self.log_length = log_length
-        self.log = []
+
+    @property
+    def scale_from(self):
+        """Raw value range (min, max)"""
+        return self._scale_from
+
+    @scale_from.setter
+    def scale_from(self, value):
+        self._scale_from = value
+        self._update_scaling()
+
+    @property
+    def scale_to(self):
+        """Scaled value range (min, max), corresponding to scale_from"""
+        return self._scale_to
+
+    @scale_to.setter
+    def scale_to(self, value):
+        self._scale_to = value
+        self._update_scaling()
+
+    def _update_scaling(self):
+        """Precalculate the linear scaling coefficients, so that val = raw * gain + offset"""
+        self.scale_from_span = self.scale_from[1] - self.scale_from[0]
+        self.scale_to_span = self.scale_to[1] - self.scale_to[0]
+        self.gain = float(self.scale_to_span) / self.scale_from_span if self.scale_from_span else 0.0
+        self.offset = self.scale_to[0] - self.scale_from[0] * self.gain
+        if self._scaler is not None:
+            self._scaler.invalidate()
+
+    def set_scaler(self, scaler, index):
+        """Read the scaled value from a BatchScaler, as its value number index"""
+        self._scaler = scaler
+        self._scaler_index = index
+
+    def bind(self, image, index, status_index=None):
+        """Read the raw value and, optionally, the status word from image.values at the given indices.
+
+        Bound devices decode their readings when accessed, rather than having them set by the adapter on every scan.
+        """
+        self._image = image
+        self._index = index
+        self._status_index = status_index
+
+    @property
+    def raw(self):
+        """Raw, unscaled value"""
+        if self._image is None:
+            return self._raw
+        return self._image.values[self._index]
+
+    @raw.setter
+    def raw(self, value):
+        self._raw = value
+
+    @property
+    def status(self):
+        """Status byte (high word)"""
+        if self._image is None or self._status_index is None:
+            return self._status
+        return self._image.values[self._status_index]
+
+    @status.setter
+    def status(self, value):
+        self._status = value
 
     @property
     def val(self):
@@ -59,7 +125,9 @@ class Device(object):
     @property
     def val_status(self):
         """Value which also takes into account the status of the device"""
-        if self.status == Device.STATUS_UNDERRANGE:
+        if self.stale:
+            return 'STALE'
+        elif self.status == Device.STATUS_UNDERRANGE:
             return 'UNDER'
         elif self.status == Device.STATUS_OVERRANGE:
             return 'OVER'
@@ -68,15 +136,41 @@ class Device(object):
 
     @property
     def healthy(self):
-        return self.status not in [Device.STATUS_UNDERRANGE, Device.STATUS_OVERRANGE]
+        return not self.stale and self.status not in [Device.STATUS_UNDERRANGE, Device.STATUS_OVERRANGE]
 
-    def _update_log(self, data):
+    @property
+    def log_length(self):
+        """Time span of the log, in seconds. 0 = logging disabled."""
+        return self._log_length
+
+    @log_length.setter
+    def log_length(self, value):
+        self._log_length = value
+
+        capacity = int(ceil(value * self.sample_rate * self.log_headroom)) + 1 if value else 0
+        try:
+            if capacity > self.log.capacity:
+                self.log.resize(capacity)
+        except AttributeError:
+            self.log = RingBuffer(capacity)
+
+    def set_sample_rate(self, rate):
+        """Set the expected rate of new readings (Hz) and resize the log buffer accordingly"""
+        self.sample_rate = rate
+        self.log_length = self.log_length
+
+    def log_reading(self, t=None):
+        """Add the current reading to the log, timestamped t (default: now). Called by adapters that do not set val."""
+        self._update_log(self.val, t)
+
+    def _update_log(self, data, t=None):
         # If logging is required, add data to the log
         if self.log_length:
-            self.log.append((time(), data))
+            if t is None:
+                t = monotonic()
+            self.log.append(t, data)
             # Delete records older than self.log_length
-            while self.log[0][0] < time() - self.log_length:
-                self.log.pop(0)
+            self.log.discard_older_than(t - self.log_length)
 
     @property
     def log_average(self):
@@ -84,30 +178,23 @@ class Device(object):
         if len(self.log) < 2:
             return self.val
 
-        return mean([l[1] for l in self.log])
+        return self.log.mean()
 
     @property
     def log_stddev(self):
         """Calculates the population standard deviation"""
-        n = len(self.log)
-        if n < 2:
+        if len(self.log) < 2:
             return 0
 
-        data = [l[1] for l in self.log]
-        pvar = ss(data) / float(n)
-        return pvar ** 0.5
+        return self.log.pvariance() ** 0.5
 
     @property
     def log_gradient(self):
         """Calculates the difference between the means of two halves of the logged data"""
-        n = len(self.log)
-        if n < 2:
+        if len(self.log) < 2:
             return 0
 
-        midpoint = n / 2
-
-        mean_1 = mean([l[1] for l in self.log[:midpoint]])
-        mean_2 = mean([l[1] for l in self.log[midpoint:]])
+        mean_1, mean_2 = self.log.half_means()
         return mean_2 - mean_1
 
     def __repr__(self):
@@ -117,10 +204,13 @@ class Device(object):
 class AIn(Device):
     length = 1
     type_str = 'a-in'
+    batch_scaled = True  # Whether the adapter can scale the value together with others (see scaling.BatchScaler)
 
     @property
     def val(self):
-        return self.scale_to[0] + (float(self.raw) - self.scale_from[0]) / self.scale_from_span * self.scale_to_span
+        if self._scaler is not None:
+            return self._scaler.value(self._scaler_index)
+        return self.raw * self.gain + self.offset
 
     @val.setter
     def val(self, value):
@@ -131,10 +221,13 @@ class AIn(Device):
 class AInStatus(AIn):
     """Analogue input with an adjacent status word, as used in Beckhoff modules"""
     length = 2
+    raw_format = 'h'  # Signed 16-bit
 
     @property
     def val(self):
-        return self.scale_to[0] + (float(self.raw) - self.scale_from[0]) / self.scale_from_span * self.scale_to_span
+        if self._scaler is not None:
+            return self._scaler.value(self._scaler_index)
+        return self.raw * self.gain + self.offset
 
     @val.setter
     def val(self, value):
@@ -145,6 +238,7 @@ class AInStatus(AIn):
 class AInTC(AIn):
     """Special case for thermocouples"""
     length = 2
+    batch_scaled = False
 
     @property
     def val(self):
@@ -159,6 +253,7 @@ class AInTC(AIn):
 class AInRaw(AIn):
     """Used for Netscanner pressure transducers. No scaling, data length 1."""
     length = 1
+    batch_scaled = False
 
     @property
     def val(self):
@@ -171,80 +266,92 @@ class AInRaw(AIn):
 
 
 class AInFloat(AIn):
-    """32-bit IEEE-754 floating point number, spanning two registers."""
+    """32-bit IEEE-754 floating point number, spanning two registers. The raw value is the float before scaling.
+
+    The word and byte order of the registers can be set with the word_order and byte_order keyword arguments (see
+    FloatCodec); both are big-endian by default.
+    """
     length = 2
+    raw_format = 'f'
+
+    def __init__(self, *args, **kwargs):
+        self.codec = FloatCodec.get(kwargs.pop('word_order', 'big'), kwargs.pop('byte_order', 'big'))
+        super(AInFloat, self).__init__(*args, **kwargs)
 
     @property
     def val(self):
-        arr = array.array('H', self.raw_array)
-        arr.byteswap()
-        val_raw = struct.unpack('>f', arr)[0]
-        return self.scale_to[0] + (val_raw - self.scale_from[0]) / self.scale_from_span * self.scale_to_span
+        if self._scaler is not None:
+            return self._scaler.value(self._scaler_index)
+        return self.raw * self.gain + self.offset
 
     @val.setter
     def val(self, value):
-        self.raw_array = value
+        """Set from a pair of register values"""
+        self.raw = self.codec.decode(value)
         self._update_log(self.val)
 
-    @property
-    def raw(self):
-        """A method to return a numeric value for the raw data array"""
-        return self.val
-
-    @raw.setter
-    def raw(self, value):
-        pass
-
 
 class AOut(Device):
     length = 1
     type_str = 'a-out'
+    dirty = True  # Whether the value has changed since it was last written to the device
 
     @property
     def val(self):
-        return self.scale_to[0] + (float(self.raw) - self.scale_from[0]) / self.scale_from_span * self.scale_to_span
+        return self.raw * self.gain + self.offset
 
     @val.setter
     def val(self, value):
-        self.raw = int(self.scale_from[0] + (float(value) - self.scale_to[0]) / self.scale_to_span * self.scale_from_span)
+        raw = int(self.scale_from[0] + (float(value) - self.scale_to[0]) / self.scale_to_span * self.scale_from_span)
+        if raw != self.raw:
+            self.raw = raw
+            self.dirty = True
         # print '{} set to {}'.format(self.tag, self.raw)
 
+    @property
+    def words(self):
+        """Register values to write to the device, starting at its address"""
+        return [self.raw]
+
 
 class AOutStatus(AOut):
     """Analogue output with an adjacent status word, as used in Beckhoff modules"""
     length = 2
 
+    @property
+    def words(self):
+        return [0, self.raw]  # Only write to low words
+
 
 class AOutFloat(AOut):
-    """32-bit IEEE-754 floating point number, spanning two registers."""
+    """32-bit IEEE-754 floating point number, spanning two registers. The raw value is the float before scaling.
+
+    The word and byte order of the registers can be set as for AInFloat.
+    """
     length = 2
 
     def __init__(self, *args, **kwargs):
+        self.codec = FloatCodec.get(kwargs.pop('word_order', 'big'), kwargs.pop('byte_order', 'big'))
+        self.raw_array = None
         super(AOutFloat, self).__init__(*args, **kwargs)
         self.val = 0
 
     @property
     def val(self):
-        arr = array.array('H', self.raw_array)
-        arr.byteswap()
-        val_raw = struct.unpack('>f', arr)[0]
-        return self.scale_to[0] + (val_raw - self.scale_from[0]) / self.scale_from_span * self.scale_to_span
+        return self.raw * self.gain + self.offset
 
     @val.setter
     def val(self, value):
         val_scaled = self.scale_from[0] + (float(value) - self.scale_to[0]) / self.scale_to_span * self.scale_from_span
-        arr = array.array('H', struct.pack('>f', val_scaled))
-        arr.byteswap()
-        self.raw_array = arr
+        words = self.codec.encode(val_scaled)
+        if words != self.raw_array:
+            self.raw_array = words
+            self.raw = self.codec.decode(words)  # Rounded to single precision, as written
+            self.dirty = True
 
     @property
-    def raw(self):
-        """A method to return a numeric value for the raw data array"""
-        return self.val
-
-    @raw.setter
-    def raw(self, value):
-        pass
+    def words(self):
+        return self.raw_array
 
 
 class DIn(Device):
@@ -264,6 +371,7 @@ class DIn(Device):
 class DOut(Device):
     length = 1
     type_str = 'd-out'
+    dirty = True  # Whether the value has changed since it was last written to the device
 
     @property
     def val(self):
@@ -271,7 +379,10 @@ class DOut(Device):
 
     @val.setter
     def val(self, value):
-        self.raw = int(value)
+        raw = int(value)
+        if raw != self.raw:
+            self.raw = raw
+            self.dirty = True
 
     def on(self):
         """Turn on a digital input"""
@@ -296,7 +407,6 @@ class InputDevice(Device):
         self.val = 0
 
         self.log_length = 0
-        self.log = []
 
     def calc(self):
         self.raw = self.val
@@ -316,7 +426,6 @@ class OutputDevice(Device):
         self.val = 0
 
         self.log_length = 0
-        self.log = []
 
     def calc(self):
         if not self.input_device or not self.output_device:
@@ -346,7 +455,6 @@ class GainDevice(Device):
         self.val = 0
 
         self.log_length = log_length
-        self.log = []
 
     def calc(self):
         self.raw = self.gain * self.input_device.val
@@ -368,14 +476,13 @@ class RampDevice(Device):
         self.status = 0
         self.raw = 0
         self.val = 0
-        self.prev_t = time()
+        self.prev_t = monotonic()
 
         self.log_length = log_length
-        self.log = []
 
     def calc(self):
         # Calculate the time step
-        t = time()
+        t = monotonic()
         time_step = t - self.prev_t
         self.prev_t = t
 
@@ -411,15 +518,14 @@ class LagDevice(Device):
         self.output = 0
         self.raw = 0
         self.val = 0
-        self.prev_t = time()
+        self.prev_t = monotonic()
 
         self.status = 0
         self.log_length = log_length
-        self.log = []
 
     def calc(self):
         # Calculate the time step
-        t = time()
+        t = monotonic()
         time_step = t - self.prev_t
         self.prev_t = t
 
@@ -452,7 +558,7 @@ class PIDDevice(Device):
         self.min_cv = min_cv
         self.max_cv = max_cv
 
-        self.prev_t = time()  # Time of the previous iteration
+        self.prev_t = monotonic()  # Time of the previous iteration
         self.cv_1 = 0  # Output signal (CV) from the previous iteration
         self.e_1 = 0  # Error (SP - PV) from the previous iteration
         self.e_2 = 0  # Error (SP - PV) from the iteration before that
@@ -461,7 +567,6 @@ class PIDDevice(Device):
         self.raw = 0
         self.val = 0
         self.log_length = 0
-        self.log = []
 
     def calc(self):
         if not self.pv_device or not self.sp_device:
@@ -469,7 +574,7 @@ class PIDDevice(Device):
 
         # Calculate the error and time step
         e = self.sp_device.val - self.pv_device.val
-        t = time()
+        t = monotonic()
         time_step = t - self.prev_t
         if time_step == 0.0:
             return self.cv_1
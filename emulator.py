@@ -0,0 +1,316 @@
+import array
+import socket
+import struct
+import threading
+import SocketServer
+from random import random, uniform
+from select import select
+from time import sleep
+
+import modbus
+from adapters import ModbusAdapter, Netscanner
+from timing import monotonic
+
+
+class Signal(object):
+    """Random walk of a raw input value within the scaling range of a device"""
+    STEP = 0.002  # Largest change per update, as a fraction of the range
+
+    def __init__(self, device):
+        self.low, self.high = sorted(device.scale_from)
+        self.value = (self.low + self.high) / 2.0
+        self.step = (self.high - self.low) * self.STEP
+
+    def update(self):
+        self.value = min(max(self.value + uniform(-self.step, self.step), self.low), self.high)
+        return self.value
+
+
+class RegisterMap(object):
+    """Input and output tables of an emulated Modbus unit, laid out as the adapter's devices expect.
+
+    Discrete inputs read as True, which keeps e.g. an E-stop input healthy. Analogue inputs follow random walks within
+    their devices' raw ranges, with a zero status word in front of the value for adapters with status words. Outputs
+    written by the adapter are kept in the coil and holding register tables.
+    """
+    def __init__(self, adapter, input_registers=None, discrete_inputs=None):
+        """input_registers, discrete_inputs: size of the input tables. The default is just large enough for the
+        adapter's devices; requests beyond the end of a table get an illegal data address exception.
+        """
+        offset = 1 if adapter.status_words else 0
+        self.signals = []  # (device, register address of its value, Signal)
+        size = 0
+        for d in adapter.a_ins.values():
+            self.signals.append((d, d.address + offset, Signal(d)))
+            size = max(size, d.address + d.length)
+        self.input_registers = array.array('H', [0] * (input_registers or size))
+
+        size = max([d.address + 1 for d in adapter.d_ins.values()] + [0])
+        self.discrete_inputs = [True] * (discrete_inputs or size)
+
+        self.coils = {}  # Key: address
+        self.holding_registers = {}
+        self.lock = threading.Lock()
+        self.update()
+
+    def update(self):
+        """Move the analogue inputs on by one step"""
+        with self.lock:
+            for device, address, signal in self.signals:
+                value = signal.update()
+                if device.raw_format == 'f':
+                    self.input_registers[address:address + 2] = array.array('H', device.codec.encode(value))
+                else:
+                    self.input_registers[address] = int(round(value)) & 0xFFFF
+
+    def execute(self, function, data):
+        """Response PDU to a request PDU"""
+        try:
+            if function == modbus.READ_DISCRETE_INPUTS:
+                address, count = struct.unpack_from('>HH', data)
+                bits = self._read(self.discrete_inputs, address, count)
+                payload = bytearray((count + 7) // 8)
+                for i, bit in enumerate(bits):
+                    if bit:
+                        payload[i >> 3] |= 1 << (i & 7)
+                return struct.pack('>BB', function, len(payload)) + str(payload)
+            elif function == modbus.READ_INPUT_REGISTERS:
+                address, count = struct.unpack_from('>HH', data)
+                with self.lock:
+                    registers = self._read(self.input_registers, address, count)
+                return struct.pack('>BB{}H'.format(count), function, 2 * count, *registers)
+            elif function == modbus.WRITE_MULTIPLE_COILS:
+                address, count, _ = struct.unpack_from('>HHB', data)
+                bits = bytearray(data[5:])
+                for i in xrange(count):
+                    self.coils[address + i] = bool(bits[i >> 3] >> (i & 7) & 1)
+                return struct.pack('>BHH', function, address, count)
+            elif function == modbus.WRITE_MULTIPLE_REGISTERS:
+                address, count, _ = struct.unpack_from('>HHB', data)
+                for i, value in enumerate(struct.unpack_from('>{}H'.format(count), data, 5)):
+                    self.holding_registers[address + i] = value
+                return struct.pack('>BHH', function, address, count)
+            return struct.pack('>BB', function | 0x80, 1)  # Illegal function
+        except IndexError:
+            return struct.pack('>BB', function | 0x80, 2)  # Illegal data address
+        except struct.error:
+            return struct.pack('>BB', function | 0x80, 3)  # Illegal data value
+
+    @staticmethod
+    def _read(table, address, count):
+        if address + count > len(table):
+            raise IndexError
+        return table[address:address + count]
+
+
+class EmulatorHandler(SocketServer.BaseRequestHandler):
+    """Serves one connection to an emulated device until the client disconnects"""
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        try:
+            self.serve()
+        except socket.error:
+            pass  # Disconnected
+
+    def serve(self):
+        pass
+
+
+class ModbusHandler(EmulatorHandler):
+    """Serves one Modbus/TCP connection. Requests are answered one at a time, as by a real bus coupler."""
+    def serve(self):
+        server = self.server
+        buf = ''
+        while not server.emulator.stopping:
+            if len(buf) >= modbus.MBAP_HEADER.size:
+                transaction_id, protocol, length, unit_id = modbus.MBAP_HEADER.unpack_from(buf)
+                end = modbus.MBAP_HEADER.size + length - 1
+                if len(buf) >= end:
+                    pdu = buf[modbus.MBAP_HEADER.size:end]
+                    buf = buf[end:]
+                    if not server.emulator.respond():
+                        continue  # Lost
+                    try:
+                        registers = server.units[unit_id]
+                    except KeyError:
+                        response = struct.pack('>BB', ord(pdu[0]) | 0x80, 0x0B)  # Gateway target failed to respond
+                    else:
+                        response = registers.execute(ord(pdu[0]), pdu[1:])
+                    header = modbus.MBAP_HEADER.pack(transaction_id, protocol, len(response) + 1, unit_id)
+                    self.request.sendall(header + response)
+                    continue
+
+            data = self.request.recv(4096)
+            if not data:
+                return
+            buf += data
+
+
+class NetscannerHandler(EmulatorHandler):
+    """Serves one Netscanner connection: ASCII read commands and an autonomous stream of binary frames"""
+    SERIAL_NUMBER = 9116
+
+    def serve(self):
+        emulator = self.server.emulator
+        channels = self.server.channels
+        buf = ''
+        period = None  # Stream frame period (s); None = not streaming
+        frame_number = 0
+        next_frame = None
+        while not emulator.stopping:
+            wait = 0.1 if period is None else max(next_frame - monotonic(), 0)
+            if select([self.request], [], [], wait)[0]:
+                data = self.request.recv(4096)
+                if not data:
+                    return
+                buf += data
+
+            # Commands: 'r' followed by a hex channel mask and a format digit, or a line starting with 'c'
+            while buf:
+                if buf[0] == 'r' and len(buf) >= 6:
+                    mask = int(buf[1:5], 16)
+                    buf = buf[6:]
+                    if emulator.respond():
+                        readings = [channels.psi(c) for c in reversed(xrange(Netscanner.CHANNELS)) if mask >> c & 1]
+                        self.request.sendall(''.join('{:12.6f}'.format(p) for p in readings))
+                elif buf[0] == 'c' and '\n' in buf:
+                    line, buf = buf.split('\n', 1)
+                    fields = line.split()
+                    if len(fields) >= 5 and fields[2] != '0':
+                        frame_period = int(fields[4])
+                        period = frame_period / 1000.0 if frame_period else 1 / Netscanner.MAX_FRAME_RATE
+                        next_frame = monotonic()
+                    else:
+                        period = None
+                elif buf[0] in 'rc':
+                    break  # Incomplete command
+                else:
+                    buf = buf[1:]
+
+            # Send the frames due, skipping the ones lost
+            frames = []
+            while period is not None and monotonic() >= next_frame:
+                frame_number = (frame_number + 1) & 0xFFFFFFFF
+                t = next_frame
+                next_frame += period
+                if emulator.respond(delay=False):
+                    frames.append(Netscanner.FRAME.pack(Netscanner.FRAME_TYPE, frame_number, self.SERIAL_NUMBER,
+                                                        int(t), int(t % 1 * 1e9),
+                                                        *[channels.psi(c) for c in xrange(Netscanner.CHANNELS)]))
+            if frames:
+                emulator.delay()
+                self.request.sendall(''.join(frames))
+
+
+class NetscannerChannels(object):
+    """Pressures of the emulated Netscanner channels, following random walks within the devices' ranges"""
+    def __init__(self, adapter):
+        self.signals = {}  # Key: channel
+        for d in adapter.a_ins.values():
+            self.signals.setdefault(d.address, Signal(d))
+        self.values = [0.0] * Netscanner.CHANNELS
+        self.update()
+
+    def update(self):
+        for channel, signal in self.signals.items():
+            self.values[channel] = signal.update() / Netscanner.PSI_TO_MBAR
+
+    def psi(self, channel):
+        return self.values[channel]
+
+
+class EmulatorServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, emulator, handler, host):
+        SocketServer.ThreadingTCPServer.__init__(self, (host, 0), handler)
+        self.emulator = emulator
+        self.port = self.socket.getsockname()[1]
+
+
+class Emulator(object):
+    """Local emulation of the remote IO of a controller, for testing and benchmarking the real adapters on a PC.
+
+    A Modbus/TCP server is set up for each Modbus host, serving a RegisterMap for each unit, and a server emulating
+    the Netscanner protocol for each Netscanner. start() points the adapters at the local servers. Each response is
+    delayed by latency +/- jitter (s), and lost with a probability of loss, in which case the adapter times out. The
+    analogue inputs are updated every update_interval.
+    """
+    def __init__(self, adapters, latency=0.0, jitter=0.0, loss=0.0, input_registers=None, discrete_inputs=None,
+                 update_interval=0.01, host='127.0.0.1'):
+        self.adapters = [a for a in adapters if isinstance(a, (ModbusAdapter, Netscanner))]
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.input_registers = input_registers
+        self.discrete_inputs = discrete_inputs
+        self.update_interval = update_interval
+        self.host = host
+        self.servers = []
+        self.tables = []  # RegisterMaps and NetscannerChannels to update
+        self.stopping = False
+
+    def start(self):
+        self.stopping = False
+        modbus_servers = {}  # Key: (host, port) of the real device
+        for adapter in self.adapters:
+            if isinstance(adapter, Netscanner):
+                server = EmulatorServer(self, NetscannerHandler, self.host)
+                server.channels = NetscannerChannels(adapter)
+                self.tables.append(server.channels)
+                adapter.ip_address = self.host
+                adapter.PORT = server.port
+            else:
+                client = adapter.mb_client
+                try:
+                    server = modbus_servers[client.host, client.port]
+                except KeyError:
+                    server = modbus_servers[client.host, client.port] = EmulatorServer(self, ModbusHandler, self.host)
+                    server.units = {}
+                registers = RegisterMap(adapter, self.input_registers, self.discrete_inputs)
+                server.units[client.unit_id] = registers
+                self.tables.append(registers)
+                adapter.stop()
+                adapter.ip_address = self.host
+                adapter.mb_client = adapter.pool.client(self.host, server.port, client.unit_id, client.connection.timeout)
+            if server not in self.servers:
+                self.servers.append(server)
+
+        for server in self.servers:
+            thread = threading.Thread(target=server.serve_forever, args=(0.1,))
+            thread.daemon = True
+            thread.start()
+        thread = threading.Thread(target=self._update_loop)
+        thread.daemon = True
+        thread.start()
+        print 'Emulating {} adapters on {} local servers'.format(len(self.adapters), len(self.servers))
+
+    def stop(self):
+        self.stopping = True
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+        self.tables = []
+
+    def respond(self, delay=True):
+        """Whether to respond to a request, after the emulated latency; False if the response is lost"""
+        if self.loss and random() < self.loss:
+            return False
+        if delay:
+            self.delay()
+        return True
+
+    def delay(self):
+        t = self.latency + uniform(-self.jitter, self.jitter)
+        if t > 0:
+            sleep(t)
+
+    def _update_loop(self):
+        while not self.stopping:
+            for table in self.tables:
+                table.update()
+            sleep(self.update_interval)
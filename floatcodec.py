@@ -0,0 +1,54 @@
+import struct
+
+
+class FloatCodec(object):
+    """Converts between floats and the pair of 16-bit registers that hold them, for a given word and byte order.
+
+    word_order is 'big' if the first register holds the most significant half of the value, and byte_order is 'big'
+    if each register is sent most significant byte first, as standard Modbus registers are. Codecs are shared between
+    devices through get().
+    """
+    _codecs = {}  # Key: (word_order, byte_order)
+
+    def __init__(self, word_order='big', byte_order='big'):
+        if word_order not in ('big', 'little') or byte_order not in ('big', 'little'):
+            raise ValueError('Word and byte order must be big or little')
+
+        self.word_order = word_order
+        self.byte_order = byte_order
+        self.swap_words = word_order == 'little'
+        self._registers = struct.Struct('>HH' if byte_order == 'big' else '<HH')
+        self._float = struct.Struct('>f')
+
+        # Positions of the bytes of a big-endian float within the registers as received
+        permutation = [2, 3, 0, 1] if self.swap_words else [0, 1, 2, 3]
+        if byte_order == 'little':
+            permutation = [permutation[1], permutation[0], permutation[3], permutation[2]]
+        self.permutation = permutation
+
+    @classmethod
+    def get(cls, word_order='big', byte_order='big'):
+        try:
+            return cls._codecs[word_order, byte_order]
+        except KeyError:
+            codec = cls._codecs[word_order, byte_order] = cls(word_order, byte_order)
+            return codec
+
+    @property
+    def standard(self):
+        """Whether the registers as received are a big-endian float, needing no reordering"""
+        return self.permutation == [0, 1, 2, 3]
+
+    def decode(self, registers):
+        """Float held in a pair of register values"""
+        first, second = registers
+        if self.swap_words:
+            first, second = second, first
+        return self._float.unpack(self._registers.pack(first, second))[0]
+
+    def encode(self, value):
+        """Pair of register values holding a float"""
+        first, second = self._registers.unpack(self._float.pack(value))
+        if self.swap_words:
+            return [second, first]
+        return [first, second]
@@ -0,0 +1,440 @@
+import mmap
+import os
+import shutil
+import struct
+import threading
+import zlib
+from collections import deque
+from numbers import Number
+from time import gmtime, strftime, time
+
+from streaming import BinaryFrameEncoder
+from timing import monotonic
+
+BLOCK_MAGIC = 'HBLK'
+BLOCK_HEADER = struct.Struct('<4sIIqqH')  # Magic, block size (bytes), rows, first and last time (us), columns
+COLUMN_HEADER = struct.Struct('<HII')  # Tag length, value data length, status data length
+STATUSES = {'UNDER': BinaryFrameEncoder.STATUS_UNDERRANGE,
+            'OVER': BinaryFrameEncoder.STATUS_OVERRANGE,
+            'STALE': BinaryFrameEncoder.STATUS_STALE}
+
+
+def shuffle(data, size):
+    """Group the bytes of an array of size-byte items by significance, so that zlib sees the runs of similar bytes"""
+    return ''.join(data[i::size] for i in xrange(size))
+
+
+def unshuffle(data, size):
+    n = len(data) // size
+    out = bytearray(len(data))
+    for i in xrange(size):
+        out[i::size] = data[i * n:(i + 1) * n]
+    return str(out)
+
+
+def encode_times(times):
+    """Compress timestamps (us) as the differences between successive intervals, which are ~0 for a steady scan"""
+    n = len(times)
+    deltas = [b - a for a, b in zip(times, times[1:])]
+    dods = [times[0]] + deltas[:1] + [b - a for a, b in zip(deltas, deltas[1:])]
+    return zlib.compress(shuffle(struct.pack('<{}q'.format(n), *dods), 8))
+
+
+def decode_times(data, n):
+    dods = struct.unpack('<{}q'.format(n), unshuffle(zlib.decompress(data), 8))
+    times = []
+    t = delta = 0
+    for i, dod in enumerate(dods):
+        if i == 0:
+            t = dod
+        else:
+            delta = dod if i == 1 else delta + dod
+            t += delta
+        times.append(t)
+    return times
+
+
+def encode_values(values):
+    """Compress floats by XORing each with the previous one (as in Gorilla), which zeroes the bits that they share"""
+    n = len(values)
+    bits = struct.unpack('<{}Q'.format(n), struct.pack('<{}d'.format(n), *values))
+    xors = [bits[0]] + [b ^ a for a, b in zip(bits, bits[1:])]
+    return zlib.compress(shuffle(struct.pack('<{}Q'.format(n), *xors), 8))
+
+
+def decode_values(data, n):
+    xors = struct.unpack('<{}Q'.format(n), unshuffle(zlib.decompress(data), 8))
+    bits = []
+    previous = 0
+    for x in xors:
+        previous ^= x
+        bits.append(previous)
+    return list(struct.unpack('<{}d'.format(n), struct.pack('<{}Q'.format(n), *bits)))
+
+
+def encode_block(times, tags, columns):
+    """Encode rows of values as a block of compressed columns.
+
+    times: list of timestamps (us); columns: list of lists of values, one for each tag. Non-numeric values are stored
+    as NaN along with a status (BinaryFrameEncoder.STATUS_*); the statuses are left out if they are all OK.
+    """
+    parts = [encode_times(times)]
+    parts.insert(0, struct.pack('<I', len(parts[0])))
+    for tag, column in zip(tags, columns):
+        values = []
+        statuses = bytearray(len(column))
+        for i, value in enumerate(column):
+            if isinstance(value, Number):
+                values.append(value)
+            else:
+                values.append(float('nan'))
+                statuses[i] = STATUSES.get(value, BinaryFrameEncoder.STATUS_NO_VALUE)
+        value_data = encode_values(values)
+        status_data = zlib.compress(str(statuses)) if any(statuses) else ''
+        tag = tag.encode('utf-8')
+        parts += [COLUMN_HEADER.pack(len(tag), len(value_data), len(status_data)), tag, value_data, status_data]
+
+    body = ''.join(parts)
+    header = BLOCK_HEADER.pack(BLOCK_MAGIC, BLOCK_HEADER.size + len(body), len(times), times[0], times[-1], len(tags))
+    return header + body
+
+
+def decode_block(data, offset=0, tags=None):
+    """Decode the block starting at offset in data. Returns (times, {tag: (values, statuses)}) for the given tags
+    (default: all). The columns of the other tags are skipped without decompressing them.
+    """
+    magic, size, rows, _, _, n_columns = BLOCK_HEADER.unpack_from(data, offset)
+    if magic != BLOCK_MAGIC:
+        raise ValueError('No block at offset {}'.format(offset))
+
+    pos = offset + BLOCK_HEADER.size
+    time_length = struct.unpack_from('<I', data, pos)[0]
+    pos += 4
+    times = decode_times(data[pos:pos + time_length], rows)
+    pos += time_length
+
+    columns = {}
+    for _ in xrange(n_columns):
+        tag_length, value_length, status_length = COLUMN_HEADER.unpack_from(data, pos)
+        pos += COLUMN_HEADER.size
+        tag = data[pos:pos + tag_length].decode('utf-8')
+        pos += tag_length
+        if tags is None or tag in tags:
+            values = decode_values(data[pos:pos + value_length], rows)
+            if status_length:
+                statuses = bytearray(zlib.decompress(data[pos + value_length:pos + value_length + status_length]))
+            else:
+                statuses = bytearray(rows)
+            columns[tag] = (values, statuses)
+        pos += value_length + status_length
+    return times, columns
+
+
+ROLLUP_RESOLUTIONS = (1, 60)  # Bucket lengths of the rollups kept by a Historian (s)
+ROLLUP_STATS = ('min', 'max', 'mean', 'count')
+
+
+def rollup_column(tag, stat):
+    """Name of the column of a rollup file holding the given statistic of a tag"""
+    return u'{}\t{}'.format(tag, stat)
+
+
+class Rollup(object):
+    """Min/max/mean/count of the values of each tag over fixed time buckets, for fast queries over long periods"""
+    def __init__(self, resolution, n_tags, rows_per_block):
+        self.resolution = resolution  # Bucket length (s)
+        self.suffix = '.{}s.hist'.format(resolution)  # Suffix of the rollup file names
+        self.n_tags = n_tags
+        self.rows_per_block = rows_per_block  # Number of finished buckets to collect before writing a block
+        self.bucket = None  # Start time of the current bucket (s)
+        self.aggregates = None  # [min, max, sum, count] of each tag in the current bucket; None = no values yet
+        self.finished = []  # Finished buckets waiting to be written: (start time, aggregates)
+
+    def add(self, t, values):
+        bucket = t // self.resolution * self.resolution
+        if bucket != self.bucket:
+            self.finish()
+            self.bucket = bucket
+            self.aggregates = [None] * self.n_tags
+
+        aggregates = self.aggregates
+        for i, value in enumerate(values):
+            if isinstance(value, Number) and value == value:  # Not NaN
+                a = aggregates[i]
+                if a is None:
+                    aggregates[i] = [value, value, value, 1]
+                else:
+                    if value < a[0]:
+                        a[0] = value
+                    elif value > a[1]:
+                        a[1] = value
+                    a[2] += value
+                    a[3] += 1
+
+    def finish(self):
+        """Close the current bucket"""
+        if self.bucket is not None:
+            self.finished.append((self.bucket, self.aggregates))
+            self.bucket = None
+
+    def columns(self, tags, buckets):
+        """Column names and values of a block of finished buckets"""
+        names = []
+        columns = []
+        nan = float('nan')
+        for i, tag in enumerate(tags):
+            aggregates = [a[i] or (nan, nan, nan, 0) for _, a in buckets]
+            names += [rollup_column(tag, stat) for stat in ROLLUP_STATS]
+            columns += [[a[0] for a in aggregates], [a[1] for a in aggregates],
+                        [a[2] / a[3] if a[3] else nan for a in aggregates], [a[3] for a in aggregates]]
+        return names, columns
+
+
+class Historian(object):
+    """Records the value of every device on every cycle of the main loop to compressed files on disk.
+
+    record() only queues the values; a background thread encodes them into blocks of compressed columns every
+    flush_interval and appends them to a file for each hour (directory/YYYY-MM-DD/HH.hist, in UTC). The files are
+    synced to disk every fsync_interval rather than after every block, so a crash loses at most the last
+    flush_interval + fsync_interval of data. Day directories older than retention days are deleted.
+
+    The writer also keeps 1 s and 1 min rollups of the values, which are written to HH.1s.hist and HH.60s.hist in the
+    same format, with min/max/mean/count columns for each tag (see rollup_column). They are written in blocks of
+    about a minute and an hour respectively, so that long queries only need to decode a few blocks.
+    """
+    def __init__(self, directory, tags, flush_interval=10.0, fsync_interval=30.0, retention=None):
+        self.directory = directory
+        self.tags = list(tags)  # Order of the values passed to record()
+        self.flush_interval = flush_interval  # Time between block writes (s)
+        self.fsync_interval = fsync_interval  # Time between syncs of the current files to disk (s)
+        self.retention = retention  # Number of days of data to keep; None = keep everything
+        self.rollups = [Rollup(resolution, len(self.tags), 60) for resolution in ROLLUP_RESOLUTIONS]
+        self.rows = 0  # Number of rows written
+        self.bytes_written = 0
+        self.raw_bytes = 0  # Size of the rows written as uncompressed doubles
+        self._queue = deque()  # Rows waiting to be written: (time (s), values)
+        self._wake = threading.Event()
+        self._running = False
+        self._thread = None
+        self._files = {}  # Open files (key: file name suffix, value: ((day, hour), file))
+        self._last_sync = monotonic()
+
+    def start(self):
+        self._running = True
+        self._wake.clear()
+        self._thread = threading.Thread(target=self._writer_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Write the queued rows and close the files"""
+        self._running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def record(self, t, values):
+        """Queue a row of values (in the order of self.tags) taken at time t (s since the epoch)"""
+        self._queue.append((t, values))
+
+    @staticmethod
+    def path_key(t):
+        """Day directory and hour of the file holding time t (s since the epoch)"""
+        tm = gmtime(t)
+        return strftime('%Y-%m-%d', tm), strftime('%H', tm)
+
+    @property
+    def stats(self):
+        return {'rows': self.rows, 'bytesWritten': self.bytes_written, 'queued': len(self._queue),
+                'compressionRatio': float(self.raw_bytes) / self.bytes_written if self.bytes_written else 0.0}
+
+    def _writer_loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            running = self._running
+            try:
+                self._write_queued(final=not running)
+                if self._files and (not running or monotonic() - self._last_sync >= self.fsync_interval):
+                    self._sync()
+                if self.retention is not None:
+                    self._delete_old()
+            except (IOError, OSError) as e:
+                print 'Historian error: {}'.format(e)
+            if not running:
+                break
+        self._close()
+
+    def _write_queued(self, final=False):
+        rows = []
+        while self._queue:
+            rows.append(self._queue.popleft())
+
+        for start, end, key in self._split_by_file([t for t, _ in rows]):
+            block_rows = rows[start:end]
+            times = [int(round(t * 1e6)) for t, _ in block_rows]
+            self._append(key, '.hist', encode_block(times, self.tags, zip(*[values for _, values in block_rows])))
+            self.rows += len(block_rows)
+            self.raw_bytes += 8 * len(block_rows) * (len(self.tags) + 1)
+
+        for rollup in self.rollups:
+            for t, values in rows:
+                rollup.add(t, values)
+            if final:
+                rollup.finish()
+            if len(rollup.finished) < rollup.rows_per_block and not final:
+                continue
+
+            buckets = rollup.finished
+            rollup.finished = []
+            for start, end, key in self._split_by_file([t for t, _ in buckets]):
+                times = [int(round(t * 1e6)) for t, _ in buckets[start:end]]
+                names, columns = rollup.columns(self.tags, buckets[start:end])
+                self._append(key, rollup.suffix, encode_block(times, names, columns))
+
+    def _split_by_file(self, times):
+        """Split a list of times into runs that go in the same file: (start index, end index, (day, hour))"""
+        runs = []
+        start = 0
+        for i in xrange(1, len(times) + 1):
+            if i == len(times) or self.path_key(times[i]) != self.path_key(times[start]):
+                runs.append((start, i, self.path_key(times[start])))
+                start = i
+        return runs
+
+    def _append(self, key, suffix, block):
+        open_key, f = self._files.get(suffix, (None, None))
+        if key != open_key:
+            if f is not None:
+                self._sync_file(f)
+                f.close()
+            day_directory = os.path.join(self.directory, key[0])
+            if not os.path.isdir(day_directory):
+                os.makedirs(day_directory)
+            f = open(os.path.join(day_directory, key[1] + suffix), 'ab')
+            self._files[suffix] = (key, f)
+
+        f.write(block)
+        f.flush()  # Make the block visible to readers; only syncing to disk is batched
+        self.bytes_written += len(block)
+
+    @staticmethod
+    def _sync_file(f):
+        f.flush()
+        os.fsync(f.fileno())
+
+    def _sync(self):
+        for _, f in self._files.values():
+            self._sync_file(f)
+        self._last_sync = monotonic()
+
+    def _close(self):
+        for _, f in self._files.values():
+            self._sync_file(f)
+            f.close()
+        self._files = {}
+
+    def _delete_old(self):
+        oldest = self.path_key(time() - self.retention * 86400)[0]
+        for day in os.listdir(self.directory):
+            if day < oldest:
+                shutil.rmtree(os.path.join(self.directory, day), ignore_errors=True)
+
+
+class HistoryReader(object):
+    """Queries the files written by a Historian, through memory maps.
+
+    Each query is answered from the coarsest data that still gives max_points buckets over the requested period:
+    the 1 min or 1 s rollups, or the raw values for short periods. Only the blocks that overlap the period are
+    decoded, and only the columns of the requested tag within them.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def query(self, tag, start, end, max_points):
+        """Downsample the values of tag between start and end (s since the epoch) to at most max_points buckets of
+        equal length. Returns the resolution of the data used (s; 0 = raw values) and a list of [bucket start time,
+        min, max, mean] for the buckets that contain any values.
+        """
+        if end <= start or max_points < 1:
+            raise ValueError('Empty query')
+
+        width = float(end - start) / max_points  # Bucket length (s)
+        resolution = max([r for r in ROLLUP_RESOLUTIONS if r <= width] or [0])
+        buckets = {}  # [min, max, sum, count] (key: bucket index)
+        for t, minimum, maximum, total, count in self._read(tag, start, end, resolution):
+            i = int((t - start) / width)
+            b = buckets.get(i)
+            if b is None:
+                buckets[i] = [minimum, maximum, total, count]
+            else:
+                b[0] = min(b[0], minimum)
+                b[1] = max(b[1], maximum)
+                b[2] += total
+                b[3] += count
+
+        return resolution, [[start + i * width, b[0], b[1], b[2] / b[3]] for i, b in sorted(buckets.items())]
+
+    def _read(self, tag, start, end, resolution):
+        """Yield (time, min, max, sum, count) for the values or rollup buckets of tag between start and end.
+
+        Any part of an hour not covered by its rollup file (e.g. the buckets not written yet) is read from the next
+        finer resolution instead.
+        """
+        suffix = '.{}s.hist'.format(resolution) if resolution else '.hist'
+        columns = [rollup_column(tag, stat) for stat in ROLLUP_STATS] if resolution else [tag]
+        hour = int(start // 3600 * 3600)
+        while hour < end:
+            window_start = max(start, hour)
+            window_end = min(end, hour + 3600)
+            covered = window_start  # End of the period covered by the rollup buckets read
+            day, hh = Historian.path_key(hour)
+            path = os.path.join(self.directory, day, hh + suffix)
+            for times, data in self._read_file(path, window_start, window_end, columns):
+                if resolution:
+                    minimums, maximums, means, counts = [data[c][0] for c in columns]
+                    for t, minimum, maximum, mean, count in zip(times, minimums, maximums, means, counts):
+                        t *= 1e-6
+                        if count and window_start <= t < window_end:
+                            yield t, minimum, maximum, mean * count, count
+                    covered = max(covered, times[-1] * 1e-6 + resolution)
+                else:
+                    values, statuses = data[tag]
+                    for t, value, status in zip(times, values, statuses):
+                        t *= 1e-6
+                        if not status and window_start <= t < window_end and value == value:
+                            yield t, value, value, value, 1
+
+            if resolution and covered < window_end:
+                finer = max([r for r in ROLLUP_RESOLUTIONS if r < resolution] or [0])
+                for point in self._read(tag, covered, window_end, finer):
+                    yield point
+            hour += 3600
+
+    @staticmethod
+    def _read_file(path, start, end, columns):
+        """Yield (times, columns) for the blocks of a file that overlap the period and contain the columns"""
+        start_us = int(start * 1e6)
+        end_us = int(end * 1e6)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return  # No data for this hour
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return
+            data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                offset = 0
+                while offset + BLOCK_HEADER.size <= size:
+                    magic, block_size, _, first, last, _ = BLOCK_HEADER.unpack_from(data, offset)
+                    if magic != BLOCK_MAGIC or offset + block_size > size:
+                        break  # Corrupt, or still being written
+                    if first < end_us and last >= start_us:
+                        times, block_columns = decode_block(data, offset, columns)
+                        if len(block_columns) == len(columns):
+                            yield times, block_columns
+                    offset += block_size
+            finally:
+                data.close()
@@ -0,0 +1,98 @@
+import struct
+from itertools import chain
+
+BITS = [tuple(bool(byte >> i & 1) for i in xrange(8)) for byte in xrange(256)]  # Bits of each byte value, LSB first
+
+
+class RegisterImage(object):
+    """Preallocated image of the input registers read from a Modbus device in one or more blocks.
+
+    The read responses are copied straight into a single buffer, which is then decoded in one pass by a struct format
+    built from the devices' raw formats (e.g. signed 16-bit for most Beckhoff analogue inputs, or floats spanning two
+    registers). Devices bound to the image read their raw values from the decoded tuple when they are accessed.
+    """
+    def __init__(self, blocks, formats=None, permutations=None):
+        """blocks: list of (start address, count, devices)
+        formats: struct format character of the value starting at each address (key: address). The default is 'H'
+            (unsigned 16-bit); four-byte formats such as 'f' span two registers.
+        permutations: byte order of the multi-register values that are not big-endian as received (key: address;
+            see FloatCodec.permutation)
+        """
+        formats = formats or {}
+        permutations = permutations or {}
+        self.blocks = blocks
+        self.offsets = []  # Index of the first register of each block in the buffer
+        self.indices = []  # Index in self.values of the value starting at each address, for each block
+        self.permutations = []  # Values to reorder before decoding: (block, byte offset in the buffer, permutation)
+        fmt = []
+        n = 0
+        for block, (start, count, _) in enumerate(blocks):
+            self.offsets.append(n)
+            self.indices.append({})
+            address = start
+            while address < start + count:
+                value_format = formats.get(address, 'H')
+                size = struct.calcsize('>' + value_format) // 2  # Number of registers
+                if address + size > start + count:
+                    raise ValueError('Value at address {} does not fit in its block'.format(address))
+
+                self.indices[block][address] = len(fmt)
+                if address in permutations:
+                    self.permutations.append((block, 2 * (n + address - start), permutations[address]))
+                fmt.append(value_format)
+                address += size
+            n += count
+
+        self.struct = struct.Struct('>' + ''.join(fmt))
+        self.buffer = bytearray(self.struct.size)
+        buffer_view = memoryview(self.buffer)
+        self.views = [buffer_view[2 * i:2 * (i + count)] for i, (_, count, _) in zip(self.offsets, blocks)]
+        self.values = self.decode()  # Decoded values; replaced as a whole after each read
+
+    def index(self, address, block=None):
+        """Index of the value starting at address in self.values, in the given block or the first one containing it"""
+        for i, indices in enumerate(self.indices):
+            if (block is None or block == i) and address in indices:
+                return indices[address]
+        raise KeyError('No value starts at address {} in the image'.format(address))
+
+    def decode(self, blocks_read=None):
+        """Decode the buffer after the blocks with the given indices (default: all) have been read.
+
+        The bytes of values in a non-standard order are reordered in place, so each block must be passed once per read.
+        """
+        buf = self.buffer
+        for block, offset, permutation in self.permutations:
+            if blocks_read is None or block in blocks_read:
+                buf[offset:offset + len(permutation)] = bytearray([buf[offset + i] for i in permutation])
+        return self.struct.unpack_from(buf)
+
+
+class BitImage(object):
+    """Preallocated image of the discrete inputs read from a Modbus device in one or more blocks.
+
+    Each block occupies a whole number of bytes in the buffer, as in the read responses. Decoding expands every byte
+    into bits through a lookup table.
+    """
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.offsets = []  # Index of the first byte of each block in the buffer
+        n = 0
+        for _, count, _ in blocks:
+            self.offsets.append(n)
+            n += (count + 7) // 8
+
+        self.buffer = bytearray(n)
+        buffer_view = memoryview(self.buffer)
+        self.views = [buffer_view[i:i + (count + 7) // 8] for i, (_, count, _) in zip(self.offsets, blocks)]
+        self.values = self.decode()  # Decoded bits, eight per byte of the buffer
+
+    def index(self, address, block=None):
+        """Index of the value of the input at address in self.values, in the given block or the first one containing it"""
+        for i, (offset, (start, count, _)) in enumerate(zip(self.offsets, self.blocks)):
+            if (block is None or block == i) and start <= address < start + count:
+                return 8 * offset + address - start
+        raise KeyError('Address {} is not in the image'.format(address))
+
+    def decode(self):
+        return tuple(chain.from_iterable(BITS[byte] for byte in self.buffer))
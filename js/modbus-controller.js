@@ -201,7 +201,7 @@ function showStage(id) {
     // Will fail when this function is first called, since the websocket is still connecting.
     try {
         if (persistentStreaming)
-            sendMessage("start-stream");
+            startStream();
         else
             sendMessage("stop-stream");
     } catch (err) {
@@ -320,7 +320,7 @@ function populateDeviceMenu(devices) {
 
 function showDeviceMenu() {
     if (!persistentStreaming)
-        sendMessage("start-stream");
+        startStream();
     $("#device-menu").show();
     $("#main-container").hide();
     $("#device-menu-btn").addClass("w3-white")
@@ -458,9 +458,15 @@ function nextNiceNumber(n) {
 
 var checkResults; // Stores the results of the check to be submitted to the database
 var websocket = new WebSocket(websocketServer);
+websocket.binaryType = "arraybuffer";  // Used for binary data frames, if requested in the server URL (?format=binary)
 var latency; // Websocket connection latency
 var checkRunning = false;
 var checkStopping = false;
+var streamSeq = null;  // Sequence number of the last delta stream message
+var streamTags = [];  // Order of the values in binary data frames
+var plotTags = [];  // Order of the values in binary plot frames
+var resyncPending = false;  // Waiting for a keyframe after a gap in the delta stream
+var historyCallbacks = {};  // Callbacks waiting for history query results (key: "<tag> <from> <to>")
 
 websocket.onopen = function() {
     // Briefly show the plots with 0 opacity in order to initialise the canvas elements' sizes
@@ -468,7 +474,7 @@ websocket.onopen = function() {
 
     console.log("Websocket connected to " + websocketServer);
     if (persistentStreaming)
-        sendMessage("start-stream");
+        startStream();
 
     if (window.location.hash == "#dev")
         showDeviceMenu();
@@ -486,6 +492,11 @@ websocket.onclose = function(evt) {
 };
 
 websocket.onmessage = function(e) {
+    if (e.data instanceof ArrayBuffer) {
+        binaryUpdate(e.data);
+        return;
+    }
+
     var spacePos = e.data.indexOf(" ");
     var cmd = e.data.substring(0, spacePos);
     var args = e.data.substring(spacePos + 1);
@@ -495,6 +506,10 @@ websocket.onmessage = function(e) {
 
     if (cmd == "data") {
         updateReadings(JSON.parse(args));
+    } else if (cmd == "delta") {
+        deltaUpdate(args);
+    } else if (cmd == "agg") {
+        updateReadings(JSON.parse(args)["mean"]);
     } else if (cmd == "plot") {
         updatePlot(JSON.parse(args));
     } else if (cmd == "results") {
@@ -511,6 +526,14 @@ websocket.onmessage = function(e) {
         stateMessage(args);
     } else if (cmd == "time") {
         calculateLatency(args);
+    } else if (cmd == "tags") {
+        streamTags = JSON.parse(args);
+    } else if (cmd == "plot-tags") {
+        plotTags = JSON.parse(args);
+    } else if (cmd == "history") {
+        historyReceived(JSON.parse(args));
+    } else if (cmd == "scan-stats") {
+        console.log("Scan statistics: ", JSON.parse(args));
     } else if (cmd == "devices") {
         // console.log(cmd + args);
         populateDeviceMenu(JSON.parse(args));
@@ -557,6 +580,80 @@ function sendMessage(message) {
     return websocket.send(message);
 }
 
+// Request the recorded values of a device between two times (ms since the epoch), downsampled to at most maxPoints
+// [time, min, max, mean] points. The callback is passed the result, with the points in result["points"].
+function requestHistory(tag, from, to, maxPoints, callback) {
+    historyCallbacks[tag + " " + from + " " + to] = callback;
+    return sendMessage("history " + tag + " " + from + " " + to + " " + maxPoints);
+}
+
+function historyReceived(result) {
+    var key = result["tag"] + " " + result["from"] + " " + result["to"];
+    var callback = historyCallbacks[key];
+    delete historyCallbacks[key];
+    if (callback)
+        callback(result);
+}
+
+function startStream() {
+    streamSeq = null;  // Wait for the initial keyframe
+    return sendMessage("start-stream delta");
+}
+
+function deltaUpdate(args) {
+    // Arguments: <sequence number> <keyframe flag> <JSON data>
+    var seqEnd = args.indexOf(" ");
+    var seq = parseInt(args.substring(0, seqEnd));
+    var keyframe = args.charAt(seqEnd + 1) == "1";
+
+    if (!keyframe && (streamSeq === null || seq != streamSeq + 1)) {
+        // A message has been missed, so the readings can no longer be patched. Ask for a keyframe.
+        if (!resyncPending) {
+            console.log("Delta stream out of sequence (" + streamSeq + " -> " + seq + "); resynchronising");
+            sendMessage("resync");
+            resyncPending = true;
+        }
+        streamSeq = null;
+        return;
+    }
+
+    streamSeq = seq;
+    if (keyframe)
+        resyncPending = false;
+    updateReadings(JSON.parse(args.substring(seqEnd + 3)));
+}
+
+function binaryUpdate(buffer) {
+    // Header (little-endian): uint8 kind, uint8 flags, uint16 value count, uint32 sequence number.
+    // Followed by the values (float64, or float32 if flag bit 0 is set) and then a status byte for each value.
+    var header = new DataView(buffer, 0, 8);
+    var kind = header.getUint8(0);
+    var float32 = header.getUint8(1) & 0x01;
+    var count = header.getUint16(2, true);
+    var values = float32 ? new Float32Array(buffer, 8, count) : new Float64Array(buffer, 8, count);
+    var statuses = new Uint8Array(buffer, 8 + count * values.BYTES_PER_ELEMENT, count);
+
+    var tags = kind == 1 ? streamTags : plotTags;
+    var data = {};
+    for (var i = 0; i < count; i++) {
+        if (statuses[i] == 0)
+            data[tags[i]] = values[i];
+        else if (statuses[i] == 1)
+            data[tags[i]] = "UNDER";
+        else if (statuses[i] == 2)
+            data[tags[i]] = "OVER";
+        else if (statuses[i] == 4)
+            data[tags[i]] = "STALE";
+        else
+            data[tags[i]] = null;
+    }
+
+    if (kind == 1)
+        updateReadings(data);
+    else if (kind == 2)
+        updatePlot(data);
+}
+
 function calculateLatency(server_time) {
     latency = moment() - moment(parseInt(server_time));
     console.log("Websocket connection latency: " + latency);
@@ -656,6 +753,31 @@ function results(data) {
     };
 }
 
+// Decode a routine's capture (base64 of Capture.export() in capture.py). Returns the time of the first sample (ms since
+// the epoch) and the samples of each tag: {"start": <ms>, "tags": {tag: {"t": [s after start], "v": [values]}}}
+function decodeCapture(base64) {
+    var bytes = Uint8Array.from(atob(base64), function(c) { return c.charCodeAt(0); });
+    var view = new DataView(bytes.buffer);
+    var tagCount = view.getUint16(4, true);
+    var capture = {"start": view.getFloat64(6, true) * 1000, "tags": {}};
+    var pos = 14;
+    for (var i = 0; i < tagCount; i++) {
+        var tagLength = view.getUint16(pos, true);
+        var count = view.getUint32(pos + 2, true);
+        pos += 6;
+        var tag = new TextDecoder("utf-8").decode(bytes.subarray(pos, pos + tagLength));
+        pos += tagLength;
+        var times = [], values = [];
+        for (var j = 0; j < count; j++) {
+            times.push(view.getFloat32(pos + 4 * j, true));
+            values.push(view.getFloat32(pos + 4 * (count + j), true));
+        }
+        pos += 8 * count;
+        capture["tags"][tag] = {"t": times, "v": values};
+    }
+    return capture;
+}
+
 function updateStatus(desc, color) {
     $("#check-status").text(desc)
         .removeClass("w3-green")
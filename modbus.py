@@ -0,0 +1,270 @@
+import socket
+import struct
+import threading
+
+
+READ_DISCRETE_INPUTS = 0x02  # Modbus function codes
+READ_INPUT_REGISTERS = 0x04
+WRITE_MULTIPLE_COILS = 0x0F
+WRITE_MULTIPLE_REGISTERS = 0x10
+
+MBAP_HEADER = struct.Struct('>HHHB')  # Transaction ID, protocol ID, length, unit ID
+
+
+class ModbusError(Exception):
+    """Modbus exception response or malformed response"""
+    pass
+
+
+class Request(object):
+    """A Modbus request PDU, along with what is needed to decode its response"""
+    def __init__(self, function, data, count=0, into=None):
+        self.function = function
+        self.data = data  # Request data following the function code
+        self.count = count  # Number of bits or registers to read
+        self.into = into  # Writable buffer to copy the data read into, instead of decoding it
+
+    def decode(self, pdu):
+        """Decode a response PDU. Returns a list of bools (bits) or ints (registers) for reads and True for writes.
+
+        If the request has an into buffer, the data read is copied into it as is and the buffer is returned instead.
+        """
+        function = ord(pdu[0])
+        if function == self.function | 0x80:
+            raise ModbusError('Exception code {} in response to function {}'.format(ord(pdu[1]), self.function))
+        elif function != self.function:
+            raise ModbusError('Response to function {} for a request with function {}'.format(function, self.function))
+
+        if self.function == READ_DISCRETE_INPUTS:
+            size = (self.count + 7) // 8
+        elif self.function == READ_INPUT_REGISTERS:
+            size = 2 * self.count
+        else:
+            return True
+
+        payload = pdu[2:2 + ord(pdu[1])]
+        if len(payload) < size:
+            raise ModbusError('Response too short')
+        if self.into is not None:
+            self.into[:] = payload[:size]
+            return self.into
+        elif self.function == READ_DISCRETE_INPUTS:
+            payload = bytearray(payload)
+            return [bool(payload[i >> 3] >> (i & 7) & 1) for i in xrange(self.count)]
+        return list(struct.unpack('>{}H'.format(self.count), payload[:size]))
+
+
+def read_discrete_inputs(address, count, into=None):
+    return Request(READ_DISCRETE_INPUTS, struct.pack('>HH', address, count), count, into)
+
+
+def read_input_registers(address, count, into=None):
+    return Request(READ_INPUT_REGISTERS, struct.pack('>HH', address, count), count, into)
+
+
+def write_multiple_coils(address, values):
+    bits = bytearray((len(values) + 7) // 8)
+    for i, value in enumerate(values):
+        if value:
+            bits[i >> 3] |= 1 << (i & 7)
+    return Request(WRITE_MULTIPLE_COILS, struct.pack('>HHB', address, len(values), len(bits)) + str(bits))
+
+
+def write_multiple_registers(address, values):
+    n = len(values)
+    words = [value & 0xFFFF for value in values]
+    return Request(WRITE_MULTIPLE_REGISTERS, struct.pack('>HHB{}H'.format(n), address, n, 2 * n, *words))
+
+
+class ModbusConnection(object):
+    """Modbus/TCP connection to a host, which may be shared by several clients (e.g. devices behind a gateway).
+
+    All the requests passed to transact() are sent in one go and their responses are matched up by transaction ID as
+    they arrive, so a batch of requests takes about one round trip rather than one round trip per request. Clients
+    take turns to transact in the order in which they asked, so that a client scanning at a fast rate cannot starve
+    the others. The socket stays open while any client is using it.
+    """
+    def __init__(self, host, port=502, timeout=5):
+        self.host = host
+        self.port = port
+        self.timeout = timeout  # Socket timeout (s)
+        self.sock = None
+        self.clients = 0  # Number of open clients using the connection
+        self.transactions = 0  # Number of batches transacted, across all clients
+        self._lock = threading.Lock()  # Serialises opening, closing and client counting
+        self._turn = threading.Condition(threading.Lock())
+        self._next_ticket = 0  # Turn numbers handed out to clients waiting to transact
+        self._serving = 0  # Turn number of the client currently allowed to transact
+        self._transaction_id = 0
+        self._buffer = ''  # Received data not yet parsed into a response
+
+    def attach(self):
+        """Register an open client. Connects if not already connected. Returns True if connected."""
+        with self._lock:
+            self.clients += 1
+            if self.sock is None:
+                try:
+                    self.sock = socket.create_connection((self.host, self.port), self.timeout)
+                    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                except socket.error:
+                    self.sock = None
+            return self.sock is not None
+
+    def detach(self):
+        """Unregister a client, closing the connection once no client is using it"""
+        with self._lock:
+            self.clients -= 1
+            if self.clients <= 0:
+                self.clients = 0
+                self._close()
+
+    def is_open(self):
+        return self.sock is not None
+
+    def _close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self._buffer = ''
+
+    def transact(self, requests, unit_id=1):
+        """Send a batch of requests and wait for all of their responses. Returns the decoded responses in request order
+        and the number of Modbus/TCP bytes sent and received.
+
+        Raises socket.error if the connection fails or times out, or ModbusError if any request fails. Either way the
+        connection is closed, so that late responses cannot be mistaken for those to later requests. The clients
+        still attached get socket.error on their next transaction and must reopen.
+        """
+        with self._turn:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while ticket != self._serving:
+                self._turn.wait()
+        try:
+            return self._transact(requests, unit_id)
+        finally:
+            with self._turn:
+                self._serving += 1
+                self._turn.notify_all()
+
+    def _transact(self, requests, unit_id):
+        if self.sock is None:
+            raise socket.error('Not connected to {}'.format(self.host))
+
+        pending = {}  # Index of each request in the batch (key: transaction ID)
+        frames = []
+        for i, request in enumerate(requests):
+            self._transaction_id = (self._transaction_id + 1) & 0xFFFF
+            pending[self._transaction_id] = i
+            header = MBAP_HEADER.pack(self._transaction_id, 0, len(request.data) + 2, unit_id)
+            frames.append(header + chr(request.function) + request.data)
+        frames = ''.join(frames)
+
+        results = [None] * len(requests)
+        received = 0
+        try:
+            self.sock.sendall(frames)
+            while pending:
+                transaction_id, pdu = self._receive_frame()
+                received += MBAP_HEADER.size + len(pdu)
+                try:
+                    i = pending.pop(transaction_id)
+                except KeyError:
+                    raise ModbusError('Unexpected transaction ID {}'.format(transaction_id))
+                results[i] = requests[i].decode(pdu)
+        except (socket.error, ModbusError):
+            with self._lock:
+                self._close()
+            raise
+
+        self.transactions += 1
+        return results, len(frames) + received
+
+    def _receive_frame(self):
+        """Block until a complete response has been received. Returns its transaction ID and PDU."""
+        while True:
+            if len(self._buffer) >= MBAP_HEADER.size:
+                transaction_id, _, length, _ = MBAP_HEADER.unpack_from(self._buffer)
+                end = MBAP_HEADER.size + length - 1
+                if length < 2:
+                    raise ModbusError('Invalid frame length {}'.format(length))
+                if len(self._buffer) >= end:
+                    pdu = self._buffer[MBAP_HEADER.size:end]
+                    self._buffer = self._buffer[end:]
+                    return transaction_id, pdu
+
+            data = self.sock.recv(4096)
+            if not data:
+                raise socket.error('Connection closed by {}'.format(self.host))
+            self._buffer += data
+
+
+class ConnectionPool(object):
+    """Shared Modbus/TCP connections, one per host and port"""
+    def __init__(self):
+        self.connections = {}  # Key: (host, port), value: ModbusConnection
+        self._lock = threading.Lock()
+
+    def connection(self, host, port=502, timeout=5):
+        with self._lock:
+            try:
+                return self.connections[host, port]
+            except KeyError:
+                connection = self.connections[host, port] = ModbusConnection(host, port, timeout)
+                return connection
+
+    def client(self, host, port=502, unit_id=1, timeout=5):
+        """New client for the given unit, sharing the connection to host and port with the pool's other clients"""
+        return ModbusClient(host, port, unit_id, timeout, pool=self)
+
+    @property
+    def stats(self):
+        """Number of clients and transactions on each connection (key: 'host:port')"""
+        return {'{}:{}'.format(*key): {'clients': c.clients, 'transactions': c.transactions}
+                for key, c in self.connections.items()}
+
+
+class ModbusClient(object):
+    """Minimal Modbus/TCP client that pipelines requests to one unit.
+
+    Clients created with a ConnectionPool share a connection with the pool's other clients for the same host and port.
+    Otherwise the client has a connection of its own.
+    """
+    def __init__(self, host, port=502, unit_id=1, timeout=5, pool=None):
+        self.host = host
+        self.port = port
+        self.unit_id = unit_id
+        if pool is None:
+            self.connection = ModbusConnection(host, port, timeout)
+        else:
+            self.connection = pool.connection(host, port, timeout)
+        self.last_transaction_bytes = 0  # Modbus/TCP bytes sent and received by the last call to transact
+        self._attached = False
+
+    def open(self):
+        """Connect to the device, or join the shared connection if it is already open. Returns True if successful."""
+        self.close()
+        self._attached = True
+        return self.connection.attach()
+
+    def is_open(self):
+        return self._attached and self.connection.is_open()
+
+    def close(self):
+        if self._attached:
+            self._attached = False
+            self.connection.detach()
+
+    def transact(self, requests):
+        """Send a batch of requests and wait for all of their responses. Returns the decoded responses in request order.
+
+        Raises socket.error or ModbusError as ModbusConnection.transact.
+        """
+        if not requests:
+            self.last_transaction_bytes = 0
+            return []
+        if not self._attached:
+            raise socket.error('Not connected to {}'.format(self.host))
+
+        results, self.last_transaction_bytes = self.connection.transact(requests, self.unit_id)
+        return results
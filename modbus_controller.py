@@ -1,12 +1,19 @@
+import BaseHTTPServer
 import json
+import Queue
 import sys
+import struct
+import threading
 import time
 import traceback
-
-from SimpleWebSocketServer import SimpleWebSocketServer, WebSocket
+import zlib
+from math import isinf
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
 
 from controller import Controller
 from reloader import Reloader
+from websocket_server import QueuedWebSocket, QueuedWebSocketServer
 
 
 def register_cmd(cmd_name):
@@ -28,13 +35,15 @@ def get_traceback(ex):
     return tb_text
 
 
-class SocketSession(WebSocket):
+class SocketSession(QueuedWebSocket):
 
     DATA_SCALED = 0
     DATA_RAW = 1
     DATA_AVG = 2
     DATA_STDDEV = 3
 
+    max_send_queue = 4  # Number of queued outbound messages above which streamed data is dropped
+
     def __init__(self, *args, **kwargs):
         super(SocketSession, self).__init__(*args, **kwargs)
         self.check_status = None
@@ -43,6 +52,18 @@ class SocketSession(WebSocket):
         self.stream_enabled = False
         self.stream_raw = False
         self.plot_enabled = False
+        self.stream_select = self.DATA_SCALED  # Overwritten by the stream-select command
+        self.stream_delta = False  # Only stream the values that have changed, after an initial keyframe
+        self.stream_seq = 0  # Sequence number of the last delta stream message
+        self.keyframe_required = False  # Send all values in the next delta stream message
+        self.pending_changes = {}  # Changes accumulated since the last delta stream message
+        self.stream_period = 0  # Minimum time between stream updates (s); 0 = every cycle
+        self.stream_window = None  # Index of the stream_period window in which the last update was sent
+        self.stream_aggregate = False  # Send the min/max/mean over each stream_period instead of the latest values
+        self.dropped_frames = 0  # Number of stream updates dropped because the outbound queue was backed up
+        self.stream_binary = False  # Stream data and plots as binary frames; negotiated when connecting
+        self.binary_float32 = False  # Use float32 instead of float64 values in binary frames
+        self.plot_tags = None  # Order of the values in the last binary plot frame sent
 
     @register_cmd('start-check')
     def start_check(self, args):
@@ -97,8 +118,38 @@ class SocketSession(WebSocket):
 
     @register_cmd('start-stream')
     def start_stream(self, args=None):
+        """Start streaming device data. Optional arguments, in any order:
+            delta - only send the values that have changed
+            <n>hz - limit the update rate, e.g. 10hz
+            agg - send the min/max/mean over each update period instead of the latest values (requires a rate limit)
+        Clients that negotiated binary streaming when connecting always receive complete frames.
+        """
+        args = [arg.lower() for arg in args or []]
+        stream_period = 0
+        for arg in args:
+            if arg.endswith('hz'):
+                try:
+                    rate = float(arg[:-2])
+                except ValueError:
+                    rate = None
+                if not rate > 0 or isinf(rate):  # Also rejects NaN
+                    self.send_error('Invalid stream rate: ' + arg)
+                    return
+                stream_period = 1.0 / rate
+
+        self.stream_period = stream_period
+
+        self.stream_delta = 'delta' in args
+        self.stream_aggregate = 'agg' in args and bool(self.stream_period)
+        self.stream_window = None
+        self.keyframe_required = True
         self.stream_enabled = True
 
+    @register_cmd('resync')
+    def resync(self, args=None):
+        """Request a keyframe, e.g. after the client has detected a gap in the delta stream sequence numbers"""
+        self.keyframe_required = True
+
     @register_cmd('stop-stream')
     def stop_stream(self, args=None):
         self.stream_enabled = False
@@ -106,29 +157,65 @@ class SocketSession(WebSocket):
     @register_cmd('stream-select')
     def stream_select(self, args=None):
         self.stream_select = int(args[0])
-
-        if self.stream_select in [self.DATA_AVG, self.DATA_STDDEV]:
-            # Enable 5-second logging for each device
-            for device in controller.devices.values():
-                device.old_log_length = device.log_length
-                device.log_length = 5.0
-        else:
-            # Revert to previous logging settings
-            for device in controller.devices.values():
-                try:
-                    device.log_length = device.old_log_length
-                except AttributeError:
-                    device.log_length = 0
+        self.keyframe_required = True
+
+        # Resizing the logs while the adapters are appending to them would corrupt them
+        with controller._adapters_locked():
+            if self.stream_select in [self.DATA_AVG, self.DATA_STDDEV]:
+                # Enable 5-second logging for each device
+                for device in controller.devices.values():
+                    device.old_log_length = device.log_length
+                    device.log_length = 5.0
+            else:
+                # Revert to previous logging settings
+                for device in controller.devices.values():
+                    try:
+                        device.log_length = device.old_log_length
+                    except AttributeError:
+                        device.log_length = 0
+
+    @register_cmd('scan-stats')
+    def send_scan_stats(self, args=None):
+        """Return the scan timing statistics (cycle time, jitter, overruns) of the controller"""
+        self.sendMessage(u'scan-stats ' + json.dumps(controller.scan_stats, separators=(',', ':')))
+
+    @register_cmd('history')
+    def send_history(self, args):
+        """Send the recorded values of a device, downsampled for plotting. Arguments: <tag> <from> <to> <max points>,
+        with the times in ms since the epoch.
+        """
+        tag = ' '.join(args[:-3])
+        start, end, max_points = float(args[-3]), float(args[-2]), int(args[-1])
+        history_queries.put((self, tag, start, end, max_points))  # Answered by answer_history_queries()
 
     @register_cmd('reload')
     def reload(self, args=None):
         reloader.reload()
 
-    def send_data(self, data):
-        self.sendMessage(u'data ' + json.dumps(data, separators=(',', ':')))
+    def send_encoded(self, msg, binary=False):
+        """Send a message that has already been encoded as UTF-8 (or binary data), e.g. a frame shared by several clients"""
+        self.send_frame(self.OPCODE_BINARY if binary else self.OPCODE_TEXT, msg)
 
-    def send_plot(self, data):
-        self.sendMessage(u'plot ' + json.dumps(data, separators=(',', ':')))
+    def send_tags(self):
+        """Send the tag table, which gives the order of the values in binary data frames"""
+        self.sendMessage(u'tags ' + json.dumps(controller.tag_table, separators=(',', ':')))
+
+    def send_plot_tags(self, tags):
+        """Send the order of the values in the following binary plot frames"""
+        self.plot_tags = tags
+        self.sendMessage(u'plot-tags ' + json.dumps(tags, separators=(',', ':')))
+
+    def send_delta(self, data, keyframe=False):
+        """Send encoded delta stream data, prefixed with the sequence number and keyframe flag"""
+        self.stream_seq += 1
+        self.keyframe_required = False
+        self.pending_changes = {}
+        self.send_encoded('delta {} {:d} {}'.format(self.stream_seq, keyframe, data))
+
+    @property
+    def backlogged(self):
+        """Whether the browser is failing to keep up with the messages sent to it"""
+        return self.queue_length > self.max_send_queue
 
     def send_results(self, data):
         if data['status'] == 'stopped':
@@ -155,20 +242,82 @@ class SocketSession(WebSocket):
             self.send_error('Unknown command')
 
     def handleConnected(self):
+        # Connect to e.g. ws://host:11000/?format=binary (or binary32 for float32 values) to use binary streaming
+        query = parse_qs(urlparse(self.request.path).query)
+        stream_format = query.get('format', [''])[0]
+        self.stream_binary = stream_format in ['binary', 'binary32']
+        self.binary_float32 = stream_format == 'binary32'
+
         self.send_time()
         self.send_devices()
+        if self.stream_binary:
+            self.send_tags()
         self.send_estop_status()
-        controller.clients.append(self)
+        controller.add_client(self)
         print '[{}]    {} connected (IP: {}) -- {} active'.format(timestamp(), self.address[1], self.address[0], len(controller.clients))
 
     def handleClose(self):
-        controller.clients.remove(self)
+        controller.remove_client(self)
         print '[{}]    {} disconnected (IP: {}) -- {} active'.format(timestamp(), self.address[1], self.address[0], len(controller.clients))
 
     def send_error(self, message):
         self.sendMessage(u'error ' + message)
 
 
+class HistoryRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers history queries over HTTP, e.g. GET /history?tag=Pressure%201&from=<ms>&to=<ms>&max_points=500"""
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/history':
+            self.send_error(404)
+            return
+
+        query = parse_qs(url.query)
+        try:
+            history = controller.history(query['tag'][0].decode('utf-8'), float(query['from'][0]),
+                                         float(query['to'][0]), int(query.get('max_points', ['1000'])[0]))
+        except (KeyError, ValueError) as e:
+            self.send_error(400, str(e))
+            return
+        except (IOError, zlib.error, struct.error) as e:  # E.g. a history file truncated or being written
+            self.send_error(500, 'Unable to read the history: {}'.format(e))
+            return
+
+        body = json.dumps(history, separators=(',', ':'))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')  # The user interface is opened from a file
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Queries are frequent while browsing the history; don't flood the console
+
+
+class HistoryServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+# History queries from websocket clients: (client, tag, from, to, max points)
+history_queries = Queue.Queue()
+
+
+def answer_history_queries():
+    """Run the websocket clients' history queries in a thread of their own, so that reading and decoding the history
+    files doesn't hold up the websocket server. The replies go through the clients' send queues.
+    """
+    while True:
+        client, tag, start, end, max_points = history_queries.get()
+        try:
+            history = controller.history(tag, start, end, max_points)
+        except Exception as e:
+            client.send_error('Error: ' + str(e))
+            continue
+        client.sendMessage(u'history ' + json.dumps(history, separators=(',', ':')))
+
+
 # Gather the method cmd_name arguments set by decorators and assemble them into a dictionary
 print 'Registered commands:'
 SocketSession.ws_cmds = {}
@@ -181,24 +330,42 @@ print
 # Main program. Had to use global scope for the Controller object, sorry :(
 start_message = 'Websocket server starting'
 simulation = False
-reloader = Reloader(['modbus_controller.py', 'controller.py', 'routines.py', 'devices.py', 'adapters.py', 'reloader.py'])
+emulation = None
+reloader = Reloader(['modbus_controller.py', 'controller.py', 'routines.py', 'devices.py', 'adapters.py', 'reloader.py',
+                     'websocket_server.py', 'streaming.py', 'timing.py', 'ringbuffer.py', 'modbus.py', 'ioimage.py',
+                     'scaling.py', 'floatcodec.py', 'emulator.py', 'historian.py', 'capture.py', 'scheduler.py'])
 
 # Command line arguments:
 if len(sys.argv) > 1:
     if sys.argv[1] == 'simulation':
         start_message = 'Websocket server starting in simulation mode'
         simulation = True
+    elif sys.argv[1] == 'emulation':
+        # Optional arguments: latency (ms), jitter (ms) and loss (fraction of responses lost)
+        emulation = {}
+        for name, arg, scale in zip(['latency', 'jitter', 'loss'], sys.argv[2:], [0.001, 0.001, 1]):
+            emulation[name] = float(arg) * scale
+        start_message = 'Websocket server starting with emulated IO'
 
 try:
-    controller = Controller(simulation=simulation)
+    controller = Controller(simulation=simulation, emulation=emulation)
     controller.start()
 
     print start_message
-    ws_server = SimpleWebSocketServer('', 11000, SocketSession)
+    ws_server = QueuedWebSocketServer('', 11000, SocketSession)
+    history_server = HistoryServer(('', 11001), HistoryRequestHandler)
+    history_thread = threading.Thread(target=history_server.serve_forever)
+    history_thread.daemon = True
+    history_thread.start()
+    history_query_thread = threading.Thread(target=answer_history_queries)
+    history_query_thread.daemon = True
+    history_query_thread.start()
 
     # Automatically reload the script if any of the below files are modified
     def before_reload():
         ws_server.close()
+        history_server.shutdown()
+        history_server.server_close()
         controller.stop()
 
     reloader.before_reload = before_reload
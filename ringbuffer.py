@@ -0,0 +1,173 @@
+import array
+from itertools import chain, islice
+
+
+class RingBuffer(object):
+    """Fixed-capacity circular buffer of timestamped samples, backed by preallocated arrays of doubles.
+
+    Appending and evicting samples are constant-time operations. Once the buffer is full, appending a new sample
+    overwrites the oldest one. Samples are addressed by their logical index, 0 being the oldest.
+
+    Running sums of the values are updated on every append and eviction, so that the mean, variance and the means
+    of the two halves of the buffer can be read in constant time. The sums are taken relative to a shift value close
+    to the mean, which keeps the variance numerically stable, and are recalculated from scratch after every
+    `capacity` updates so that rounding errors cannot accumulate.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array.array('d', [0.0]) * capacity  # Sample timestamps
+        self.values = array.array('d', [0.0]) * capacity  # Sample values
+        self.start = 0  # Position of the oldest sample in the arrays
+        self.count = 0  # Number of samples currently in the buffer
+        self._resync()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, t, value):
+        """Add a sample to the end of the buffer, evicting the oldest one if the buffer is full"""
+        if not self.capacity:
+            return
+        if self.count == self.capacity:
+            self.popleft()
+
+        if not self.count:  # Centre the sums on the first sample until the next resync
+            self._shift = value
+            self._sum = self._sumsq = self._first_sum = 0.0
+
+        i = (self.start + self.count) % self.capacity
+        self.times[i] = t
+        self.values[i] = value
+        self.count += 1
+
+        x = value - self._shift
+        self._sum += x
+        self._sumsq += x * x
+        self._split()
+        self._count_update()
+
+    def popleft(self):
+        """Remove the oldest sample and return its value"""
+        value = self.values[self.start]
+        self.start = (self.start + 1) % self.capacity
+        self.count -= 1
+
+        x = value - self._shift
+        self._sum -= x
+        self._sumsq -= x * x
+        if self._first_count:  # The oldest sample belongs to the first half
+            self._first_count -= 1
+            self._first_sum -= x
+        self._split()
+        self._count_update()
+
+        return value
+
+    def discard_older_than(self, t):
+        """Remove all samples with a timestamp earlier than t"""
+        while self.count and self.times[self.start] < t:
+            self.popleft()
+
+    def clear(self):
+        self.start = 0
+        self.count = 0
+        self._resync()
+
+    def resize(self, capacity):
+        """Change the capacity of the buffer, keeping as many of the newest samples as will fit"""
+        keep = min(self.count, capacity)
+        times = array.array('d', self.window(self.count - keep, times=True))
+        values = array.array('d', self.window(self.count - keep))
+
+        self.capacity = capacity
+        self.times = times + array.array('d', [0.0]) * (capacity - keep)
+        self.values = values + array.array('d', [0.0]) * (capacity - keep)
+        self.start = 0
+        self.count = keep
+        self._resync()
+
+    def segments(self, first=0, last=None):
+        """Return the (start, stop) array index ranges holding the samples first to last (exclusive).
+
+        There are at most two ranges, since the samples may wrap around the end of the arrays.
+        """
+        if last is None:
+            last = self.count
+        if last <= first:
+            return []
+
+        a = (self.start + first) % self.capacity
+        b = a + last - first
+        if b <= self.capacity:
+            return [(a, b)]
+        return [(a, self.capacity), (0, b - self.capacity)]
+
+    def window(self, first=0, last=None, times=False):
+        """Iterate over the values (or timestamps) of samples first to last (exclusive) without copying them"""
+        data = self.times if times else self.values
+        return chain.from_iterable(islice(data, a, b) for a, b in self.segments(first, last))
+
+    def sum(self, first=0, last=None):
+        """Sum of the values of samples first to last (exclusive)"""
+        return sum(self.window(first, last))
+
+    def __getitem__(self, index):
+        """Return the (timestamp, value) of a sample by its logical index"""
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('RingBuffer index out of range')
+
+        i = (self.start + index) % self.capacity
+        return self.times[i], self.values[i]
+
+    def mean(self):
+        """Mean of all values in the buffer"""
+        if not self.count:
+            return None
+        return self._shift + self._sum / self.count
+
+    def pvariance(self):
+        """Population variance of all values in the buffer"""
+        if not self.count:
+            return None
+        pvar = (self._sumsq - self._sum * self._sum / self.count) / self.count
+        return max(pvar, 0.0)  # Guard against tiny negative values caused by rounding
+
+    def half_means(self):
+        """Means of the older and newer halves of the values in the buffer. The newer half is larger for odd counts."""
+        if self.count < 2:
+            return None, None
+        second_count = self.count - self._first_count
+        mean_1 = self._shift + self._first_sum / self._first_count
+        mean_2 = self._shift + (self._sum - self._first_sum) / second_count
+        return mean_1, mean_2
+
+    def _split(self):
+        """Move samples between the running sums of the two halves after the count has changed"""
+        midpoint = self.count // 2
+        while self._first_count < midpoint:
+            self._first_sum += self.values[(self.start + self._first_count) % self.capacity] - self._shift
+            self._first_count += 1
+        while self._first_count > midpoint:
+            self._first_count -= 1
+            self._first_sum -= self.values[(self.start + self._first_count) % self.capacity] - self._shift
+
+    def _count_update(self):
+        self._updates += 1
+        if self._updates >= self.capacity:
+            self._resync()
+
+    def _resync(self):
+        """Recalculate the running sums from the buffer contents, shifted by the current mean"""
+        self._updates = 0
+        self._shift = self.sum() / self.count if self.count else 0.0
+        self._sum = 0.0
+        self._sumsq = 0.0
+        for x in self.window():
+            x -= self._shift
+            self._sum += x
+            self._sumsq += x * x
+
+        self._first_count = self.count // 2
+        self._first_sum = self.sum(0, self._first_count) - self._shift * self._first_count
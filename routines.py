@@ -1,6 +1,9 @@
+import base64
+import inspect
 from time import time, sleep
 
 from devices import AOut, AIn, DOut, LagDevice, PIDDevice, InputDevice, OutputDevice
+from timing import monotonic
 
 
 """Any subclass of Routine in this file will be automatically added to the Check Controller as a callable routine."""
@@ -21,40 +24,140 @@ class NotHealthyException(Exception):
     pass
 
 
+class Wait(object):
+    """Something that a coroutine routine waits for, by yielding it from its _run generator. The RoutineScheduler
+    checks it on every cycle of the controller, after the routine's safety check and stop and pause requests.
+    """
+    def __init__(self, routine):
+        self.routine = routine
+        self.paused = False  # Whether the pause has been reported to the clients
+
+    def check(self, now):
+        """Whether the routine can carry on; raises StopException if it has been stopped"""
+        routine = self.routine
+        routine.safety_check()
+        if not routine._running:
+            raise StopException
+        if routine._paused:
+            if not self.paused:
+                self.paused = True
+                routine.controller.state_message('paused')
+            return False
+        if self.paused:
+            self.paused = False
+            routine.controller.state_message('resumed')
+        return self.ready(now)
+
+    def ready(self, now):
+        return True
+
+
+class Delay(Wait):
+    def __init__(self, routine, seconds):
+        Wait.__init__(self, routine)
+        self.end = monotonic() + seconds
+
+    def ready(self, now):
+        return now >= self.end
+
+
+class WaitFor(Wait):
+    def __init__(self, routine, condition, timeout):
+        Wait.__init__(self, routine)
+        self.condition = condition
+        self.end = monotonic() + timeout
+
+    def ready(self, now):
+        if self.condition():
+            return True
+        if now >= self.end:
+            raise TimeoutException
+        return False
+
+
 class Routine(object):
-    """A generic routine run on the controller, e.g. a leak check"""
+    """A generic routine run on the controller, e.g. a leak check.
+
+    A routine runs in its own thread by default. If _run is a generator function, it runs as a coroutine on the
+    controller's RoutineScheduler instead, alongside any number of other routines, and must yield the results of
+    delay(), wait_for() and pause_loop() rather than have them block, e.g. `yield self.delay(1)`. Yielding None waits
+    for the next cycle, and yielding a generator runs it as a subroutine (its return value is not passed back).
+    """
 
     name = 'Generic'  # Name used for calling the routine externally
 
     def __init__(self, controller):
         """Call this in every child class, before other initialisation code"""
         self.controller = controller
+        self.id = self.name  # Instance ID, assigned by the controller when the routine is called
+        self.captures = []  # Capture sessions opened by the routine; closed when it finishes
+        self._cycle = None  # Number of the controller cycle whose values the routine has last seen
+
+    @property
+    def coroutine(self):
+        """Whether the routine runs as a coroutine on the controller's RoutineScheduler"""
+        return inspect.isgeneratorfunction(self._run)
 
     def run(self):
-        self._running = True
-        self._paused = False
+        self._start()
         try:
+            try:
+                self._reset()
+                self._run()
+            except StopException:
+                pass
+            except Exception as e:
+                self.controller.error_message(e)
+
+            # Once self._run returns, the routine has completed or stopped with an exception
             self._reset()
-            self._run()
         except StopException:
-            pass
+            pass  # Stopped while resetting
+        except Exception as e:
+            self.controller.error_message(e)
+        finally:
+            self._finish()
+
+    def run_coroutine(self):
+        """Generator equivalent of run(), driven by the RoutineScheduler. _reset may also be a generator function."""
+        self._start()
+        try:
+            try:
+                yield self._reset()
+                yield self._run()
+            except StopException:
+                pass
+            except Exception as e:
+                self.controller.error_message(e)
+
+            yield self._reset()
+        except StopException:
+            pass  # Stopped while resetting
         except Exception as e:
             self.controller.error_message(e)
+        finally:
+            self._finish()
+
+    def _start(self):
+        self._running = True
+        self._paused = False
 
-        # Once self._run returns, the routine has completed or stopped with an exception
-        self._reset()
+    def _finish(self):
+        self.close_captures()
         self.stop()
         self.controller.results_message({}, 'stopped')
         # self.controller.on_plot = None  # TODO: only remove this routine's on_plot method?
 
         # Remove routine from controller's lists of active routines... not the best way to do this, I know
         try:
-            del self.controller.routines[self.name]
+            del self.controller.routines[self.id]
         except KeyError:
             pass
 
     def _run(self):
-        """Override this in a child class to give it functionality. Check for self._running every now and then for a stop signal."""
+        """Override this in a child class to give it functionality. Check for self._running every now and then for a stop signal.
+        Make it a generator function to run the routine as a coroutine.
+        """
         pass
 
     def _reset(self):
@@ -70,20 +173,43 @@ class Routine(object):
         """Override this in a child class to have it return data that will be plotted in the HMI"""
         return {}
 
+    def open_capture(self, devices, length):
+        """Record the given devices (key: name in the capture) over a sliding window of length seconds, sampled on
+        every cycle of the controller. Returns the Capture.
+        """
+        capture = self.controller.open_capture(devices, length)
+        self.captures.append(capture)
+        return capture
+
+    def close_captures(self):
+        for capture in self.captures:
+            self.controller.close_capture(capture)
+        self.captures = []
+
     def safety_check(self):
         """Override this in a child class to check any critical transducers etc."""
         pass
 
     def stop(self):
         self._running = False
+        self.controller.wake()
 
     def pause(self):
         self._paused = True
+        self.controller.wake()
 
     def resume(self):
         self._paused = False
+        self.controller.wake()
+
+    def wait_cycle(self):
+        """Wait for the controller's next cycle, so that the devices have fresh values, or for a stop/pause/resume"""
+        self._cycle = self.controller.wait_cycle(self._cycle)
 
     def pause_loop(self):
+        if self.coroutine:
+            return Wait(self)
+
         if self._paused:
             self.controller.state_message('paused')
         else:
@@ -93,20 +219,26 @@ class Routine(object):
             self.safety_check()
             if not self._running:
                 raise StopException
-            sleep(0.1)
+            self.wait_cycle()
 
         self.controller.state_message('resumed')
 
     def delay(self, seconds):
+        if self.coroutine:
+            return Delay(self, seconds)
+
         start_time = time()
         while time() < start_time + seconds:
             self.safety_check()
             self.pause_loop()  # Pause if requested
             if not self._running:  # Stop the routine if requested
                 raise StopException
-            sleep(0.1)
+            self.wait_cycle()
 
     def wait_for(self, condition, timeout=60):
+        if self.coroutine:
+            return WaitFor(self, condition, timeout)
+
         start_time = time()
         while time() < start_time + timeout:
             if condition():
@@ -116,13 +248,14 @@ class Routine(object):
             self.pause_loop()  # Pause if requested
             if not self._running:  # Stop the routine if requested
                 raise StopException
-            sleep(0.1)
+            self.wait_cycle()
 
         raise TimeoutException
 
     def warning_message(self, msg):
+        """Show a warning and pause for it to be read. Like delay(), a coroutine routine must yield the result."""
         self.controller.status_message(msg, 'amber')
-        self.delay(5)
+        return self.delay(5)
 
     def __repr__(self):
         return self.name
@@ -140,8 +273,9 @@ class LeakCheck(Routine):
         self.pressure_delay = 60  # Time to wait for the pressure to stabilise
         self.pressure_error_threshold = 0.02
         self.flow_delay = 120  # Maximum time to wait for the flow rate to stabilise
-        self.log_interval_1 = 10  # Log interval for the first part of the check (gradient checks)
-        self.log_interval_2 = 20  # Log interval for the second part of the check (recording results)
+        self.log_interval_1 = 10  # Capture length for the first part of the check (gradient checks)
+        self.log_interval_2 = 20  # Capture length for the second part of the check (recording results)
+        self.capture = None  # Capture of the pressure ('p') and flow rate ('m') for calculating statistics
         self.gradient_threshold = 1.0  # Maximum absolute value of gradient
 
         # Get devices from parent controller
@@ -180,8 +314,9 @@ class LeakCheck(Routine):
         # Open the vent valve
         self.vent_valve.on()
 
-        # Disable logging
-        self.set_log_intervals(0)
+        # Stop capturing
+        self.close_captures()
+        self.capture = None
 
     def _run(self):
         self.controller.status_message('Starting leak check')
@@ -190,8 +325,8 @@ class LeakCheck(Routine):
         self.delay(1)
         self.vent_valve.off()
 
-        # Log the pressure and flow rate seconds for calculating statistics
-        self.set_log_intervals(self.log_interval_1)
+        # Capture the pressure and flow rate for calculating statistics
+        self.capture = self.open_capture({'p': self.pressure_pv, 'm': self.flow_meter}, self.log_interval_1)
 
         # Perform health check on devices
         all_healthy = True
@@ -215,13 +350,6 @@ class LeakCheck(Routine):
 
         self.record_results()
 
-    def set_log_intervals(self, value):
-        self.pressure_pv.log_length = value
-        self.flow_meter.log_length = value
-        self.controller.devices['Flow meter 1'].log_length = value  # Configure all of the Flow meter because any one might be used
-        self.controller.devices['Flow meter 2'].log_length = value
-        self.controller.devices['Flow meter 3'].log_length = value
-
     def set_pressure(self):
         self.controller.status_message('Setting pressure setpoint')
         self.pressure_sp.val = self.config['pressureSP']
@@ -278,7 +406,7 @@ class LeakCheck(Routine):
             if not self.flow_meter.healthy or self.flow_meter.val == 0.0:
                 raise NotHealthyException
 
-            gradient = self.flow_meter.log_gradient
+            gradient = self.capture.gradient('m')
             print '\tGradient:', gradient
             return abs(gradient) < self.gradient_threshold
 
@@ -293,13 +421,14 @@ class LeakCheck(Routine):
 
     def record_results(self):
         self.controller.status_message('Recording results')
-        self.set_log_intervals(self.log_interval_2)
+        self.capture.length = self.log_interval_2
         self.delay(self.log_interval_2)
 
-        result = {'p': self.pressure_pv.log_average,
-                  'm': self.flow_meter.log_average,
+        result = {'p': self.capture.mean('p'),
+                  'm': self.capture.mean('m'),
                   'pa': self.amb_pressure.val,
-                  'ta': self.amb_temperature.val}
+                  'ta': self.amb_temperature.val,
+                  'capture': base64.b64encode(self.capture.export())}
         passed = self.flow_meter.val <= self.config['maxLeakage'] and self.flow_meter.healthy  # Measured mass flow below USL
         if passed:
             self.controller.results_message(result, 'passed')
@@ -0,0 +1,51 @@
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class BatchScaler(object):
+    """Scales the raw values of a set of analogue inputs bound to an input image, all in one pass.
+
+    Each device's linear scaling is reduced to a gain and an offset. The scaled values are calculated the first time
+    one of them is read after the image has been updated, and cached until the next update or calibration change.
+    NumPy is used for large sets of devices if it is available, since its per-call overhead outweighs the gain for
+    only a handful of values.
+    """
+    NUMPY_MIN_DEVICES = 32
+
+    def __init__(self, image, devices):
+        """image: RegisterImage; devices: list of (device, index of its raw value in image.values)"""
+        self.image = image
+        self.devices = [d for d, _ in devices]
+        self.indices = [i for _, i in devices]
+        self.use_numpy = numpy is not None and len(devices) >= self.NUMPY_MIN_DEVICES
+        self._cache = (None, None)  # The image values and the scaled values calculated from them
+        self.invalidate()
+        for i, d in enumerate(self.devices):
+            d.set_scaler(self, i)
+
+    def invalidate(self):
+        """Recalculate the coefficients after a calibration change"""
+        if self.use_numpy:
+            self._indices = numpy.array(self.indices, dtype=numpy.intp)
+            self._gains = numpy.array([d.gain for d in self.devices])
+            self._offsets = numpy.array([d.offset for d in self.devices])
+        else:
+            self._gains = array.array('d', [d.gain for d in self.devices])
+            self._offsets = array.array('d', [d.offset for d in self.devices])
+        self._cache = (None, None)
+
+    def value(self, i):
+        """Scaled value of device i"""
+        raw = self.image.values
+        source, values = self._cache  # Read as one tuple, since other threads may be updating the cache
+        if source is not raw:
+            if self.use_numpy:
+                values = (numpy.asarray(raw, dtype=numpy.float64)[self._indices] * self._gains + self._offsets).tolist()
+            else:
+                values = [raw[j] * gain + offset for j, gain, offset in zip(self.indices, self._gains, self._offsets)]
+            self._cache = (raw, values)
+        return values[i]
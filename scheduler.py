@@ -0,0 +1,103 @@
+import threading
+import types
+from collections import deque
+from traceback import print_exc
+
+from timing import monotonic
+
+
+class Task(object):
+    """A coroutine routine being run by the RoutineScheduler, as a stack of generators (the last one is running)"""
+    def __init__(self, routine):
+        self.routine = routine
+        self.stack = [routine.run_coroutine()]
+        self.wait = None  # What the running generator is waiting for: a Wait, or None for the next cycle
+
+    def step(self, now):
+        """Run the routine until it next waits, if what it is waiting for has happened. Returns False once it has
+        finished.
+        """
+        value, error = None, None
+        if self.wait is not None:
+            try:
+                if not self.wait.check(now):
+                    return True
+            except Exception as e:  # Stopped or timed out; raised in the routine
+                error = e
+            self.wait = None
+
+        while True:
+            generator = self.stack[-1]
+            try:
+                if error is None:
+                    result = generator.send(value)
+                else:
+                    result = generator.throw(error)
+            except StopIteration:
+                error = None
+                self.stack.pop()
+            except Exception as e:
+                error = e
+                self.stack.pop()
+                if not self.stack:
+                    print 'Unhandled exception in routine', self.routine.id
+                    print_exc()
+                    return False
+            else:
+                error = None
+                if isinstance(result, types.GeneratorType):
+                    self.stack.append(result)  # Run a subroutine
+                    continue
+                if result is None:
+                    return True  # Carry on in the next cycle
+                try:
+                    if not result.check(now):
+                        self.wait = result
+                        return True
+                except Exception as e:
+                    error = e
+                continue
+
+            if not self.stack:
+                return False
+            value = None
+
+
+class RoutineScheduler(object):
+    """Runs the coroutine routines of a controller on one thread. After every cycle of the controller's main loop,
+    each routine that isn't waiting for anything else is run until it next yields.
+    """
+    def __init__(self, controller):
+        self.controller = controller
+        self.tasks = []  # Only accessed by the scheduler thread
+        self._new_tasks = deque()  # Routines added by other threads, to be picked up in the next cycle
+        self.step_time = 0.0  # Time taken to step all the routines in the most recent cycle (s)
+        self.max_step_time = 0.0
+        self._thread = None
+
+    def add(self, routine):
+        self._new_tasks.append(routine)
+        self.controller.wake()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _loop(self):
+        cycle = None
+        while self.controller._running or self.tasks or self._new_tasks:
+            cycle = self.controller.wait_cycle(cycle)
+            while self._new_tasks:
+                self.tasks.append(Task(self._new_tasks.popleft()))
+            if not self.tasks:
+                continue
+
+            t = monotonic()
+            self.tasks = [task for task in self.tasks if task.step(t)]
+            self.step_time = monotonic() - t
+            self.max_step_time = max(self.max_step_time, self.step_time)
+
+    @property
+    def stats(self):
+        return {'routines': len(self.tasks), 'stepTime': self.step_time * 1000, 'maxStepTime': self.max_step_time * 1000}
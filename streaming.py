@@ -0,0 +1,173 @@
+import struct
+from math import copysign
+from numbers import Number
+
+
+class DeltaStream(object):
+    """Tracks the values last published for one stream variant and works out which of them have changed.
+
+    A value counts as changed if it differs from the last published one by more than the device's deadband. Changes
+    below the deadband accumulate until they exceed it. A keyframe containing every value is due periodically, so
+    that clients can recover from any inconsistencies.
+    """
+    def __init__(self, devices, keyframe_interval=5.0):
+        self.deadbands = {device.tag: device.deadband for device in devices.values()}  # Key: tag name
+        self.keyframe_interval = keyframe_interval  # Time between keyframes (s)
+        self.published = {}  # Last published value of each tag
+        self.last_keyframe = None  # Time of the last keyframe
+
+    def update(self, data, t):
+        """Compare data with the last published values.
+
+        Returns a tuple (keyframe, changes): whether a keyframe is due at time t and a dictionary of the changed values.
+        """
+        if self.last_keyframe is None or t - self.last_keyframe >= self.keyframe_interval:
+            self.last_keyframe = t
+            self.published = dict(data)
+            return True, data
+
+        changes = {}
+        for tag, value in data.iteritems():
+            try:
+                published = self.published[tag]
+            except KeyError:
+                changes[tag] = value
+                continue
+
+            if isinstance(value, Number) and isinstance(published, Number):
+                changed = abs(value - published) > self.deadbands[tag]
+            else:  # E.g. a status string such as 'UNDER'
+                changed = value != published
+
+            if changed:
+                changes[tag] = value
+
+        self.published.update(changes)
+        return False, changes
+
+
+class StreamAggregator(object):
+    """Accumulates the minimum, maximum and mean of each value over consecutive fixed-length time windows.
+
+    Windows are aligned to multiples of the period, so that all clients streaming at the same rate can share the
+    results. Non-numeric values (e.g. status strings) are passed through as the latest value.
+    """
+    def __init__(self, period):
+        self.period = period  # Window length (s)
+        self.window = None  # Index of the current window
+        self.result = None  # Aggregates of the last completed window: {'min': {...}, 'max': {...}, 'mean': {...}}
+        self._clear()
+
+    def _clear(self):
+        self._count = {}
+        self._sum = {}
+        self._min = {}
+        self._max = {}
+        self._latest = {}
+
+    def add(self, data, t):
+        """Add the values in data, read at time t. Completes the current window if t falls into the next one."""
+        window = int(t / self.period)
+        if window != self.window:
+            if self._count or self._latest:
+                mean = {tag: self._sum[tag] / self._count[tag] for tag in self._count}
+                mean.update(self._latest)
+                self.result = {'min': self._min, 'max': self._max, 'mean': mean}
+            self.window = window
+            self._clear()
+
+        for tag, value in data.iteritems():
+            if not isinstance(value, Number):
+                self._latest[tag] = value
+            elif tag in self._count:
+                self._count[tag] += 1
+                self._sum[tag] += value
+                if value < self._min[tag]:
+                    self._min[tag] = value
+                elif value > self._max[tag]:
+                    self._max[tag] = value
+            else:
+                self._count[tag] = 1
+                self._sum[tag] = float(value)
+                self._min[tag] = value
+                self._max[tag] = value
+
+
+class StreamFrames(object):
+    """The data streamed in one controller cycle. Each message is encoded on demand, at most once, and shared by all
+    the clients that receive it."""
+    def __init__(self, streams, encode, seq=0):
+        self.streams = streams  # Data for each stream variant (key: stream_select)
+        self.seq = seq  # Sequence number for binary frames
+        self.keyframes = {}  # Whether a delta stream keyframe is due for each variant
+        self.changes = {}  # Values changed since the previous cycle for each delta-streamed variant
+        self.aggregates = {}  # Results of the last completed aggregation windows (key: (stream_select, period))
+        self._encode = encode
+        self._encoded = {}
+        self._packed = {}
+
+    def encoded(self, kind, key):
+        """Encoded message data, where kind is 'streams', 'changes' or 'aggregates' and key selects the variant"""
+        try:
+            return self._encoded[kind, key]
+        except KeyError:
+            msg = self._encoded[kind, key] = self._encode(getattr(self, kind)[key])
+            return msg
+
+    def packed(self, variant, encoder):
+        """Stream data for a variant, packed into a binary frame by a BinaryFrameEncoder"""
+        try:
+            return self._packed[variant, encoder]
+        except KeyError:
+            frame = self._packed[variant, encoder] = encoder.pack(self.streams[variant], self.seq)
+            return frame
+
+
+class BinaryFrameEncoder(object):
+    """Packs stream data into binary websocket frames, as an alternative to JSON for large device trees.
+
+    The values are sent in the order of a tag table, which is sent to the client once beforehand. Frame layout
+    (little-endian):
+        uint8 kind (KIND_DATA or KIND_PLOT), uint8 flags (FLAG_FLOAT32), uint16 value count, uint32 sequence number
+        value count x float64 (or float32, if FLAG_FLOAT32 is set) values; NaN if there is no numeric value
+        value count x uint8 status (STATUS_*)
+    """
+    KIND_DATA = 1
+    KIND_PLOT = 2
+
+    FLAG_FLOAT32 = 0x01
+
+    STATUS_OK = 0
+    STATUS_UNDERRANGE = 1
+    STATUS_OVERRANGE = 2
+    STATUS_NO_VALUE = 3  # E.g. None or an unrecognised string
+    STATUS_STALE = 4  # The device's adapter is disconnected
+
+    FLOAT32_MAX = 3.4028234663852886e38
+
+    def __init__(self, kind, tags, float32=False):
+        self.kind = kind
+        self.tags = tags  # Tag table, giving the order of the values in the frame
+        self.float32 = float32
+        self.flags = self.FLAG_FLOAT32 if float32 else 0
+        n = len(tags)
+        self.struct = struct.Struct('<BBHI{0}{1}{0}B'.format(n, 'f' if float32 else 'd'))
+        self.statuses = {'UNDER': self.STATUS_UNDERRANGE, 'OVER': self.STATUS_OVERRANGE, 'STALE': self.STATUS_STALE}
+
+    def pack(self, data, seq=0):
+        """Pack a dictionary of values (key: tag) into a frame. Tags missing from data are sent without a value."""
+        values = []
+        statuses = []
+        for tag in self.tags:
+            value = data.get(tag)
+            if isinstance(value, Number):
+                if self.float32 and abs(value) > self.FLOAT32_MAX:
+                    value = copysign(float('inf'), value)  # Would otherwise fail to pack
+                values.append(value)
+                statuses.append(self.STATUS_OK)
+            else:
+                values.append(float('nan'))
+                statuses.append(self.statuses.get(value, self.STATUS_NO_VALUE))
+
+        frame = self.struct.pack(self.kind, self.flags, len(self.tags), seq & 0xFFFFFFFF, *(values + statuses))
+        return bytearray(frame)  # The websocket server would treat a str as text
@@ -0,0 +1,68 @@
+import random
+import unittest
+
+from ringbuffer import RingBuffer
+
+
+def two_pass_pvariance(values):
+    mean = sum(values) / len(values)
+    return sum((x - mean) ** 2 for x in values) / len(values)
+
+
+class RingBufferVarianceTest(unittest.TestCase):
+    def assert_variance(self, buf, values):
+        expected = two_pass_pvariance(values)
+        self.assertAlmostEqual(buf.pvariance(), expected, delta=1e-6 * expected + 1e-9)
+        self.assertAlmostEqual(buf.mean(), sum(values) / len(values), delta=1e-9)
+
+    def test_large_offset_before_resync(self):
+        """Values around 1e6 +/- 1, checked after every append before the first resync"""
+        rng = random.Random(1)
+        buf = RingBuffer(1000)
+        values = []
+        for i in xrange(500):
+            values.append(1e6 + rng.uniform(-1, 1))
+            buf.append(i, values[-1])
+            if len(values) > 1:
+                self.assert_variance(buf, values)
+
+    def test_large_offset_after_clear_and_resize(self):
+        rng = random.Random(2)
+        buf = RingBuffer(100)
+        for i in xrange(150):
+            buf.append(i, rng.uniform(-10, 10))
+        buf.clear()
+        values = []
+        for i in xrange(50):
+            values.append(1e6 + rng.uniform(-1e-2, 1e-2))
+            buf.append(i, values[-1])
+        self.assert_variance(buf, values)
+
+        buf.resize(200)
+        for i in xrange(50):
+            values.append(1e6 + rng.uniform(-1e-2, 1e-2))
+            buf.append(50 + i, values[-1])
+        self.assert_variance(buf, values)
+
+    def test_eviction(self):
+        rng = random.Random(3)
+        buf = RingBuffer(64)
+        values = []
+        for i in xrange(1000):
+            values.append(5e5 + rng.gauss(0, 0.5))
+            buf.append(i, values[-1])
+            if len(values) > 1:
+                self.assert_variance(buf, values[-64:])
+        self.assertEqual(len(buf), 64)
+
+    def test_half_means(self):
+        buf = RingBuffer(10)
+        for i, value in enumerate([1e6 + x for x in (1, 2, 3, 4, 5)]):
+            buf.append(i, value)
+        mean_1, mean_2 = buf.half_means()
+        self.assertAlmostEqual(mean_1, 1e6 + 1.5)
+        self.assertAlmostEqual(mean_2, 1e6 + 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import os
+import sys
+from time import sleep
+
+try:
+    from time import monotonic  # Python 3.3+
+except ImportError:
+    if sys.platform == 'win32':
+        from time import clock as monotonic  # Based on QueryPerformanceCounter on Windows
+    else:
+        import ctypes
+        import ctypes.util
+
+        CLOCK_MONOTONIC = 1  # From <linux/time.h>
+
+        class _Timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        _libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        _clock_gettime = _libc.clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+        def monotonic():
+            """Return the value (in fractional seconds) of a clock that cannot go backwards"""
+            t = _Timespec()
+            if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return t.tv_sec + t.tv_nsec * 1e-9
+
+
+class CycleTimer(object):
+    """Paces a loop to a fixed period against a monotonic clock and keeps track of its timing statistics.
+
+    Cycle start times are scheduled as multiples of the period from the first cycle, so that sleep inaccuracies do
+    not accumulate into drift. If a cycle overruns, the missed slots are skipped rather than run back-to-back.
+    """
+    def __init__(self, period):
+        self.period = period  # Cycle time (s)
+        self._next_start = None  # Scheduled start time of the current cycle
+        self._cycle_start = None  # Actual start time of the current cycle
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.cycles = 0  # Number of completed cycles
+        self.overruns = 0  # Number of cycles whose execution took longer than the period
+        self.exec_time = 0.0  # Execution time of the most recent cycle (s)
+        self.max_exec_time = 0.0
+        self.jitter = 0.0  # Difference between the scheduled and actual start of the most recent cycle (s)
+        self.max_jitter = 0.0
+        self._jitter_sum = 0.0
+
+    def start(self):
+        """Mark the start of the first cycle"""
+        self._next_start = self._cycle_start = monotonic()
+
+    def wait(self):
+        """Mark the end of the current cycle and sleep until the start of the next one"""
+        if self._next_start is None:
+            self.start()
+            return
+
+        now = monotonic()
+        self.exec_time = now - self._cycle_start
+        self.max_exec_time = max(self.max_exec_time, self.exec_time)
+        self.cycles += 1
+
+        self._next_start += self.period
+        if now > self._next_start:
+            self.overruns += 1
+            missed = int((now - self._next_start) / self.period) + 1
+            self._next_start += missed * self.period
+
+        sleep(self._next_start - now)
+
+        self._cycle_start = monotonic()
+        self.jitter = self._cycle_start - self._next_start
+        self.max_jitter = max(self.max_jitter, self.jitter)
+        self._jitter_sum += self.jitter
+
+    @property
+    def stats(self):
+        """Timing statistics (in milliseconds) for reporting to clients"""
+        return {'period': self.period * 1000,
+                'cycles': self.cycles,
+                'overruns': self.overruns,
+                'execTime': self.exec_time * 1000,
+                'maxExecTime': self.max_exec_time * 1000,
+                'jitter': self.jitter * 1000,
+                'meanJitter': self._jitter_sum / self.cycles * 1000 if self.cycles else 0.0,
+                'maxJitter': self.max_jitter * 1000}
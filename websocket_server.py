@@ -0,0 +1,149 @@
+import socket
+from collections import deque
+from select import select
+
+from SimpleWebSocketServer import SimpleWebSocketServer, WebSocket
+
+
+def socket_pair():
+    """Return a pair of connected sockets. socket.socketpair is not available on Windows under Python 2."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(listener.getsockname())
+        server, _ = listener.accept()
+    finally:
+        listener.close()
+
+    server.setblocking(0)
+    client.setblocking(0)
+    return server, client
+
+
+class QueuedWebSocket(WebSocket):
+    """Websocket connection that can be sent messages from any thread.
+
+    Messages are put in an outbox and framed and written to the socket by the server thread, so that no other thread
+    ever touches the socket or its send queue.
+    """
+
+    OPCODE_TEXT = 0x1  # Websocket frame opcodes
+    OPCODE_BINARY = 0x2
+
+    def __init__(self, *args, **kwargs):
+        super(QueuedWebSocket, self).__init__(*args, **kwargs)
+        self.outbox = deque()  # Messages waiting to be handed over to the server thread: (opcode, data)
+
+    def sendMessage(self, data):
+        """Send a websocket message. Strings are sent as text frames and bytearrays as binary frames."""
+        self.send_frame(self.OPCODE_TEXT if isinstance(data, basestring) else self.OPCODE_BINARY, data)
+
+    def send_frame(self, opcode, data):
+        """Queue a message for sending. Binary data must be a bytearray, since Python 2 strings are encoded as UTF-8."""
+        self.outbox.append((opcode, data))
+        self.server.wake()
+
+    def flush_outbox(self):
+        """Move the messages from the outbox to the send queue. Must only be called from the server thread."""
+        while self.outbox:
+            opcode, data = self.outbox.popleft()
+            self._sendMessage(False, opcode, data)
+
+    @property
+    def queue_length(self):
+        """Number of outgoing messages that have not been written to the socket yet"""
+        return len(self.outbox) + len(self.sendq)
+
+
+class QueuedWebSocketServer(SimpleWebSocketServer):
+    """Websocket server for QueuedWebSocket connections.
+
+    Other threads wake the server up through a socket pair when they queue messages, so that the messages are sent
+    straight away rather than after the select timeout.
+    """
+    def __init__(self, *args, **kwargs):
+        super(QueuedWebSocketServer, self).__init__(*args, **kwargs)
+        self._wake_receiver, self._wake_sender = socket_pair()
+        self._wake_pending = False
+
+    def wake(self):
+        """Interrupt the select call in the server thread. Safe to call from any thread."""
+        if self._wake_pending:
+            return
+
+        self._wake_pending = True
+        try:
+            self._wake_sender.send(b'\0')
+        except socket.error:
+            pass  # The socket buffer is full, so the server is going to wake up anyway
+
+    def close(self):
+        super(QueuedWebSocketServer, self).close()
+        self._wake_receiver.close()
+        self._wake_sender.close()
+
+    def _remove_client(self, fileno):
+        self._handleClose(self.connections[fileno])
+        del self.connections[fileno]
+        self.listeners.remove(fileno)
+
+    def serveonce(self):
+        """SimpleWebSocketServer.serveonce with the outboxes flushed and the wake-up socket added to the select call.
+        Relies on the library's internals, so its version is pinned in the Pipfile.
+        """
+        # Clear the flag before flushing, so that any message queued after this point triggers another wake-up
+        self._wake_pending = False
+        for client in self.connections.values():
+            client.flush_outbox()
+
+        writers = [fileno for fileno, client in self.connections.items() if client.sendq]
+        rList, wList, xList = select(self.listeners + [self._wake_receiver], writers, self.listeners, self.selectInterval)
+
+        if self._wake_receiver in rList:
+            rList.remove(self._wake_receiver)
+            try:
+                self._wake_receiver.recv(4096)
+            except socket.error:
+                pass
+
+        for ready in wList:
+            client = self.connections[ready]
+            try:
+                while client.sendq:
+                    opcode, payload = client.sendq.popleft()
+                    remaining = client._sendBuffer(payload)
+                    if remaining is not None:
+                        client.sendq.appendleft((opcode, remaining))
+                        break
+                    elif opcode == 0x8:  # Close frame
+                        raise Exception('received client close')
+            except Exception:
+                self._remove_client(ready)
+
+        for ready in rList:
+            if ready == self.serversocket:
+                sock = None
+                try:
+                    sock, address = self.serversocket.accept()
+                    newsock = self._decorateSocket(sock)
+                    newsock.setblocking(0)
+                    fileno = newsock.fileno()
+                    self.connections[fileno] = self._constructWebSocket(newsock, address)
+                    self.listeners.append(fileno)
+                except Exception:
+                    if sock is not None:
+                        sock.close()
+            elif ready in self.connections:
+                try:
+                    self.connections[ready]._handleData()
+                except Exception:
+                    self._remove_client(ready)
+
+        for failed in xList:
+            if failed == self.serversocket:
+                self.close()
+                raise Exception('server socket failed')
+            elif failed in self.connections:
+                self._remove_client(failed)